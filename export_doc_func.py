@@ -4,29 +4,54 @@ import base64
 import datetime
 import time
 import io
+import os
+import tempfile
+import threading
 import asyncio
 import logging
 import hashlib
 import struct
 import zlib
 import binascii
+import copy
+import functools
+import itertools
 from pathlib import Path
-from dataclasses import dataclass
-from typing import Optional, Callable, Awaitable, Any, List, Tuple, Dict, cast
+from typing import (
+    Optional,
+    Callable,
+    Awaitable,
+    Any,
+    List,
+    NamedTuple,
+    Tuple,
+    Dict,
+    cast,
+)
 from urllib.parse import quote
+from xml.sax.saxutils import quoteattr
 from docx import Document
-from docx.shared import Pt, Inches, RGBColor, Cm
+from docx.shared import Pt, Inches, RGBColor, Cm, Length
 from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_LINE_SPACING
 from docx.enum.table import WD_TABLE_ALIGNMENT
 from docx.enum.style import WD_STYLE_TYPE
 from docx.opc.constants import RELATIONSHIP_TYPE as RT
 from docx.oxml import parse_xml
-from docx.oxml.ns import qn, nsmap
+from docx.oxml.ns import qn, nsmap, nsdecls
 from docx.oxml import OxmlElement
+from docx.oxml.shape import CT_Inline
+from lxml import etree
 from open_webui.models.chats import Chats
 from open_webui.models.users import Users
 from open_webui.utils.chat import generate_chat_completion
 from pydantic import BaseModel, Field
+# Direct column query for chat titles; falls back to Chats.get_chat_by_id when absent.
+try:
+    from open_webui.internal.db import get_db  # type: ignore
+    from open_webui.models.chats import Chat  # type: ignore
+except Exception:  # pragma: no cover - depends on host Open WebUI runtime
+    get_db = None
+    Chat = None
 # Files are used to embed internal /api/v1/files/<id>/content images.
 try:
     from open_webui.models.files import Files  # type: ignore
@@ -50,31 +75,286 @@ except Exception:
 try:
     import boto3
     from botocore.config import Config as BotoConfig
-    import os
     BOTO3_AVAILABLE = True
 except ImportError:
     BOTO3_AVAILABLE = False
+# urllib3 for pooled (keep-alive) HTTP image downloads; urllib.request otherwise
+try:
+    import urllib3
+    URLLIB3_AVAILABLE = True
+except ImportError:
+    URLLIB3_AVAILABLE = False
+# pybase64 for SIMD-accelerated base64 encoding of the exported DOCX
+try:
+    from pybase64 import b64encode as _b64encode
+except ImportError:
+    _b64encode = base64.b64encode
 
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
 )
 logger = logging.getLogger(__name__)
+# Earliest position where an inline construct may start (one scan instead of a
+# str.find per marker); "\(" is covered by the backslash.
+_INLINE_SPECIAL_RE = re.compile(r"[`!\[*_~$\\]|https?://|www\.")
 _AUTO_URL_RE = re.compile(r"(?:https?://|www\.)[^\s<>()]+")
+# Punctuation that usually follows a URL in prose rather than belonging to it.
+_URL_TRAILING_PUNCT = ".,;:!?)]}"
 _DATA_IMAGE_URL_RE = re.compile(
     r"^data:(?P<mime>image/[a-z0-9.+-]+)\s*;\s*base64\s*,\s*(?P<b64>.*)$",
-    re.IGNORECASE | re.DOTALL,
+    re.IGNORECASE | re.DOTALL | re.ASCII,
+)
+# Image MIME types python-docx can embed (PNG, JPEG, GIF, BMP, TIFF).
+_DOCX_IMAGE_MIMES = frozenset(
+    {
+        "image/png",
+        "image/jpeg",
+        "image/jpg",
+        "image/pjpeg",
+        "image/gif",
+        "image/bmp",
+        "image/x-bmp",
+        "image/x-ms-bmp",
+        "image/tiff",
+    }
+)
+# (offset, magic) pairs python-docx's image header parsers accept.
+_DOCX_IMAGE_SIGNATURES = (
+    (0, b"\x89PNG\r\n\x1a\n"),
+    (6, b"JFIF"),
+    (6, b"Exif"),
+    (0, b"GIF87a"),
+    (0, b"GIF89a"),
+    (0, b"MM\x00*"),
+    (0, b"II*\x00"),
+    (0, b"BM"),
 )
 _OWUI_API_FILE_ID_RE = re.compile(
     r"/api/v1/files/(?P<id>[A-Za-z0-9-]+)(?:/content)?(?:[/?#]|$)",
-    re.IGNORECASE,
+    re.IGNORECASE | re.ASCII,
 )
-_CURRENCY_NUMBER_RE = re.compile(r"^\d[\d,]*(?:\.\d+)?$")
+_MD_IMAGE_RE = re.compile(r"!\[[^\]]*\]\((?P<url>[^)]*)\)")
+_IMAGE_PREFETCH_CONCURRENCY = 10
+# Data URLs at least this long (~256KB decoded) are decoded in a worker thread.
+_DATA_URL_ASYNC_DECODE_MIN_CHARS = 256 * 1024 * 4 // 3
+# boto3 clients are thread-safe; share one per S3 config (and process) so image
+# fetches reuse pooled connections. Key: (pid, endpoint, access key, secret, style).
+_S3_CLIENTS: Dict[Tuple[int, str, str, str, str], Any] = {}
+_S3_CLIENTS_LOCK = threading.Lock()
+# Shared across exports so downloads from the same host reuse connections.
+_HTTP_POOL = (
+    urllib3.PoolManager(
+        num_pools=10,
+        maxsize=_IMAGE_PREFETCH_CONCURRENCY,
+        timeout=urllib3.Timeout(connect=5, read=15),
+        # Failed requests are retried twice per error kind; redirects keep urllib's
+        # limit of 10 (a shared total would count them too). With no total, "other"
+        # must be bounded or e.g. SSL errors would be retried forever.
+        retries=urllib3.Retry(
+            total=None,
+            connect=2,
+            read=2,
+            other=2,
+            redirect=10,
+            backoff_factor=0.2,
+        ),
+    )
+    if URLLIB3_AVAILABLE
+    else None
+)
+# Short-lived cache of chat titles keyed by (chat_id, user_id).
+_CHAT_TITLE_CACHE_TTL = 30.0
+_CHAT_TITLE_CACHE_MAX = 512
+# Amounts like "5" or "1,234.50"; ASCII digits only, as written after a "$" sign.
+_CURRENCY_NUMBER_RE = re.compile(r"^\d[\d,]*(?:\.\d+)?$", re.ASCII)
+# Big-endian uint32 (PNG chunk lengths and CRCs).
+_STRUCT_U32 = struct.Struct("!I")
 _TRANSPARENT_1PX_PNG = base64.b64decode(
     "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVQImWNgYGBgAAAABQABDQottAAAAABJRU5ErkJggg=="
 )
+
+def _png_iend_span(png_bytes: bytes) -> Optional[Tuple[int, int]]:
+    """(start, end) of the IEND chunk, found by walking chunk headers in place."""
+    total = len(png_bytes)
+    offset = 8
+    while offset + 8 <= total:
+        chunk_end = offset + 12 + _STRUCT_U32.unpack_from(png_bytes, offset)[0]
+        if chunk_end > total:
+            return None
+        if png_bytes.startswith(b"IEND", offset + 4):
+            return offset, chunk_end
+        offset = chunk_end
+    return None
+
+_TEXT_CHUNK_TYPE_CRC = zlib.crc32(b"tEXt")
+
+def _png_text_chunk(keyword: str, value: str) -> bytes:
+    """
+    Ensure placeholder PNGs stay distinct in the DOCX package:
+    python-docx may deduplicate identical image bytes into one media part.
+    We insert a small tEXt chunk so each placeholder is unique, without changing
+    dimensions or requiring external imaging libraries.
+    """
+    keyword_b = (keyword or "owui").encode("latin-1", errors="ignore")[:79]
+    keyword_b = keyword_b.replace(b"\x00", b"") or b"owui"
+    value_b = (value or "").encode("latin-1", errors="ignore")
+    data = keyword_b + b"\x00" + value_b
+    size = len(data)
+    # Running CRC over type then data; no concatenated temporary.
+    crc = zlib.crc32(data, _TEXT_CHUNK_TYPE_CRC) & 0xFFFFFFFF
+    # Length, type, data and CRC packed in one call.
+    return struct.pack(f"!I4s{size}sI", size, b"tEXt", data, crc)
+
+# SVG blip attached to each placeholder; the client overwrites it with the render.
+_DUMMY_MERMAID_SVG = (
+    b'<svg xmlns="http://www.w3.org/2000/svg" width="1" height="1" viewBox="0 0 1 1">'
+    b"</svg>"
+)
+
+# The placeholder template split around its IEND chunk once, at import.
+_PLACEHOLDER_IEND_START, _PLACEHOLDER_IEND_END = cast(
+    Tuple[int, int], _png_iend_span(_TRANSPARENT_1PX_PNG)
+)
+_PLACEHOLDER_PNG_HEAD = _TRANSPARENT_1PX_PNG[:_PLACEHOLDER_IEND_START]
+_PLACEHOLDER_PNG_IEND = _TRANSPARENT_1PX_PNG[
+    _PLACEHOLDER_IEND_START:_PLACEHOLDER_IEND_END
+]
+
+@functools.lru_cache(maxsize=512)
+def _mermaid_placeholder_png(seed: str) -> bytes:
+    """Template PNG tagged with seed; pure, so re-exports reuse earlier bytes."""
+    return b"".join(
+        (_PLACEHOLDER_PNG_HEAD, _png_text_chunk("owui", seed), _PLACEHOLDER_PNG_IEND)
+    )
+
 _ASVG_NS = "http://schemas.microsoft.com/office/drawing/2016/SVG/main"
+_OMML_NS = "http://schemas.openxmlformats.org/officeDocument/2006/math"
+_WML_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+# Namespace-declaring opening tags for OMML fragments passed to parse_xml.
+_OMATH_PARA_OPEN = f'<m:oMathPara xmlns:m="{_OMML_NS}" xmlns:w="{_WML_NS}">'
+_OMATH_OPEN_NS = f'<m:oMath xmlns:m="{_OMML_NS}">'
 nsmap.setdefault("asvg", _ASVG_NS)
+# Run/hyperlink XML built once and deep-copied per use instead of assembling the
+# same rPr tree element by element. Text and r:id are set on the copy.
+_HYPERLINK_TEMPLATE = parse_xml(
+    f'<w:hyperlink {nsdecls("w", "r")} r:id=""><w:r><w:rPr>'
+    '<w:rStyle w:val="Hyperlink"/><w:color w:val="0000FF"/><w:u w:val="single"/>'
+    "</w:rPr><w:t/></w:r></w:hyperlink>"
+)
+# Paragraph borders: horizontal rule (bottom) and blockquote (thick gray left
+# border, 4pt from the text).
+_HR_BORDER_TEMPLATE = parse_xml(
+    f'<w:pBdr {nsdecls("w")}>'
+    '<w:bottom w:val="single" w:sz="6" w:space="1" w:color="auto"/></w:pBdr>'
+)
+_BLOCKQUOTE_BORDER_TEMPLATE = parse_xml(
+    f'<w:pBdr {nsdecls("w")}>'
+    '<w:left w:val="single" w:sz="24" w:space="4" w:color="CCCCCC"/></w:pBdr>'
+)
+_W_FILL = qn("w:fill")
+# Lengths reused per table cell and list item; Pt()/Cm() convert on every call.
+_PT_0 = Pt(0)
+_PT_9 = Pt(9)
+
+@functools.lru_cache(maxsize=16)
+def _list_left_indent(level: int) -> Length:
+    """Left indent of a list item at nesting level (0.5cm per level)."""
+    return Cm(0.5 * (level + 1))
+
+# Code block paragraph properties (twips): 0.5cm left indent, 6pt after, 3pt
+# before below a language label (6pt otherwise), F7F7F7 shading.
+_CODE_BLOCK_PPR = parse_xml(
+    f'<w:pPr {nsdecls("w")}><w:spacing w:before="120" w:after="120"/>'
+    '<w:ind w:left="283"/><w:shd w:fill="F7F7F7"/></w:pPr>'
+)
+_CODE_BLOCK_LABELED_PPR = parse_xml(
+    f'<w:pPr {nsdecls("w")}><w:spacing w:before="60" w:after="120"/>'
+    '<w:ind w:left="283"/><w:shd w:fill="F7F7F7"/></w:pPr>'
+)
+# Table cell text runs: 9pt, bold in the header row.
+_CELL_RUN_RPR = parse_xml(f'<w:rPr {nsdecls("w")}><w:sz w:val="18"/></w:rPr>')
+_CELL_BOLD_RUN_RPR = parse_xml(
+    f'<w:rPr {nsdecls("w")}><w:b/><w:sz w:val="18"/></w:rPr>'
+)
+_INTERNAL_HYPERLINK_TEMPLATE = parse_xml(
+    f'<w:hyperlink {nsdecls("w")} w:anchor=""><w:r><w:rPr>'
+    '<w:rStyle w:val="Hyperlink"/></w:rPr><w:t/></w:r></w:hyperlink>'
+)
+
+@functools.lru_cache(maxsize=8)
+def _code_run_rpr(font: str):
+    """Inline code rPr for font (10pt, grey shading); deepcopy before inserting."""
+    font_attr = quoteattr(font)
+    return parse_xml(
+        f'<w:rPr {nsdecls("w")}><w:rFonts w:ascii={font_attr} w:hAnsi={font_attr}'
+        f' w:eastAsia={font_attr}/><w:sz w:val="20"/><w:shd w:fill="E8E8E8"/>'
+        "</w:rPr>"
+    )
+
+@functools.lru_cache(maxsize=8)
+def _code_hyperlink_template(font: str):
+    """Hyperlinked inline code run for font; deepcopy, then set r:id and text."""
+    font_attr = quoteattr(font)
+    return parse_xml(
+        f'<w:hyperlink {nsdecls("w", "r")} r:id=""><w:r><w:rPr>'
+        f"<w:rFonts w:ascii={font_attr} w:hAnsi={font_attr} w:eastAsia={font_attr}/>"
+        '<w:sz w:val="20"/><w:szCs w:val="20"/><w:shd w:fill="E8E8E8"/>'
+        "</w:rPr><w:t/></w:r></w:hyperlink>"
+    )
+
+@functools.lru_cache(maxsize=64)
+def _code_block_run_rpr(font: str, color: Optional[RGBColor], bold: bool):
+    """Code block token rPr (10pt, optional bold/color); deepcopy before inserting."""
+    font_attr = quoteattr(font)
+    bold_xml = "<w:b/>" if bold else ""
+    color_xml = f'<w:color w:val="{color}"/>' if color else ""
+    return parse_xml(
+        f'<w:rPr {nsdecls("w")}><w:rFonts w:ascii={font_attr} w:hAnsi={font_attr}'
+        f' w:eastAsia={font_attr}/>{bold_xml}{color_xml}<w:sz w:val="20"/></w:rPr>'
+    )
+
+_W_R = qn("w:r")
+_W_T = qn("w:t")
+_W_TAB = qn("w:tab")
+_W_BR = qn("w:br")
+_XML_SPACE = qn("xml:space")
+_RUN_TEXT_SPLIT_RE = re.compile(r"([\t\r\n])")
+
+def _append_run(p, text: str, rpr) -> None:
+    """
+    Append a w:r with a copy of rpr and text to paragraph element p.
+    Same content as python-docx's run.text (tab -> w:tab, CR/LF -> w:br), but
+    split with one regex pass instead of its per-character appender.
+    """
+    r = etree.SubElement(p, _W_R)
+    r.append(copy.deepcopy(rpr))
+    for piece in _RUN_TEXT_SPLIT_RE.split(text):
+        if not piece:
+            continue
+        if piece == "\t":
+            etree.SubElement(r, _W_TAB)
+        elif piece == "\n" or piece == "\r":
+            etree.SubElement(r, _W_BR)
+        else:
+            t = etree.SubElement(r, _W_T)
+            t.text = piece
+            if len(piece.strip()) < len(piece):
+                t.set(_XML_SPACE, "preserve")
+
+_REASONING_MARKERS = ("<details", "<think", "<analysis")
+# Open/close tags of the elements that can carry model reasoning. Attributes stop
+# at the next "<" as well, so an unterminated tag cannot make every later tag
+# rescan to the end of the text (the scan stays linear).
+_REASONING_TAG_RE = re.compile(
+    r"<(?P<close>/?)(?P<name>details|think|analysis)\b(?P<attrs>[^<>]*)>",
+    re.IGNORECASE,
+)
+_REASONING_TYPE_ATTR_RE = re.compile(
+    r"\btype\s*=\s*(?:\"reasoning\"|'reasoning'|reasoning)", re.IGNORECASE
+)
+# Whole-block patterns that end at the first matching close tag; used when the
+# tag scan finds reasoning that mentions its own tags.
 _REASONING_DETAILS_RE = re.compile(
     r"<details\b[^>]*\btype\s*=\s*(?:\"reasoning\"|'reasoning'|reasoning)[^>]*>.*?</details\s*>",
     re.IGNORECASE | re.DOTALL,
@@ -83,15 +363,578 @@ _THINK_RE = re.compile(r"<think\b[^>]*>.*?</think\s*>", re.IGNORECASE | re.DOTAL
 _ANALYSIS_RE = re.compile(
     r"<analysis\b[^>]*>.*?</analysis\s*>", re.IGNORECASE | re.DOTALL
 )
+_WHITESPACE_RE = re.compile(r"\s+")
+_EXCESS_BLANK_LINES_RE = re.compile(r"\n{4,}")
+# Lowercase scheme prefixes of stored paths that are not on the local disk.
+_NON_LOCAL_PATH_PREFIXES = ("s3://", "gs://", "http://", "https://")
+_HTTP_URL_PREFIXES = ("http://", "https://")
+_B64_WHITESPACE_DROP = dict.fromkeys(map(ord, " \t\r\n\f\v"))
+_FILENAME_ILLEGAL_RE = re.compile(r'[\\/*?:"<>|]')
+# str.translate table deleting emoji from filenames: common emoji blocks (including
+# flag regional indicators and skin tones), VS15/VS16, ZWJ, keycap and tag characters.
+_EMOJI_DELETE_TABLE = dict.fromkeys(
+    itertools.chain(
+        range(0x1F000, 0x1FB00),
+        range(0x2600, 0x2700),
+        range(0x2700, 0x27C0),
+        range(0x2300, 0x2400),
+        range(0x2B00, 0x2C00),
+        (0x200D, 0xFE0E, 0xFE0F, 0x20E3),
+        range(0xE0020, 0xE0080),
+    )
+)
+# Markdown block-level syntax
+_H1_RE = re.compile(r"^#\s+.+$", re.MULTILINE)
+_TITLE_HEADING_RE = re.compile(r"^#{1,2}\s+(.+)$")
+# extract_title only looks at this many leading lines.
+_TITLE_SCAN_MAX_LINES = 64
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.+)$")
+_UNORDERED_LIST_RE = re.compile(r"^(\s*)[-*+]\s+(.+)$")
+_ORDERED_LIST_RE = re.compile(r"^(\s*)\d+[.)]\s+(.+)$")
+_HR_RE = re.compile(r"^[-*_]{3,}$")
+# First (stripped) characters that can start a table, heading, list, quote or rule.
+_BLOCK_START_CHARS = frozenset("|#-*+>_")
+_DISPLAY_MATH_BRACKET_RE = re.compile(r"^\\\[(.*)\\\]$")
+_DISPLAY_MATH_DOLLAR_RE = re.compile(r"^\$\$(.*)\$\$$")
+# Tables
+_HEX_COLOR_RE = re.compile(r"[0-9A-Fa-f]{6}")
+_TABLE_CELL_BREAK_RE = re.compile(r"(?:<br\s*/?>|\n)")
+_MD_INLINE_CODE_RE = re.compile(r"`([^`]+)`")
+_MD_LINK_RE = re.compile(r"\[([^\]]+)\]\(([^)]+)\)")
+
+@functools.lru_cache(maxsize=16)
+def _valid_hex_color(value: str, default: str) -> str:
+    """RRGGBB from a valve value (optional "#"), else default; once per value."""
+    c = value.strip().lstrip("#")
+    if _HEX_COLOR_RE.fullmatch(c):
+        return c
+    return default
+
+# Mermaid
+_MERMAID_LR_RE = re.compile(
+    r"^(graph|flowchart)\s+LR\b", re.MULTILINE | re.IGNORECASE
+)
+_MERMAID_HEADER_TITLE_RE = re.compile(
+    r"^(?P<header>\S.*?)(?:\s+title\s*:?\s+)(?P<title>.+)$", re.IGNORECASE
+)
+# title "Foo" (quoted branch tried first) / title Foo
+_MERMAID_TITLE_RE = re.compile(
+    r'^title\s*:?\s+(?:"(?P<quoted>.+)"\s*$|(?P<plain>.+)$)', re.IGNORECASE
+)
+# Both title forms above contain the word; most diagrams have neither.
+_MERMAID_TITLE_WORD_RE = re.compile(r"title", re.IGNORECASE)
+_MERMAID_TITLE_DIRECTIVE_RE = re.compile(r'^title\s*:?\s+(".+"|.+)$', re.IGNORECASE)
+# Code-block syntax highlighting: token type -> (color, bold), resolved through the
+# Pygments token hierarchy once per token type instead of once per token.
+if PYGMENTS_AVAILABLE:
+    _TOKEN_COLORS: Dict[Any, RGBColor] = {
+        Token.Keyword: RGBColor(0, 92, 197),  # macOS blue - keywords
+        Token.Keyword.Constant: RGBColor(0, 92, 197),
+        Token.Keyword.Declaration: RGBColor(0, 92, 197),
+        Token.Keyword.Namespace: RGBColor(0, 92, 197),
+        Token.Keyword.Type: RGBColor(0, 92, 197),
+        Token.Name.Function: RGBColor(0, 0, 0),  # Functions stay black
+        Token.Name.Class: RGBColor(38, 82, 120),  # Deep cyan-blue - classes
+        Token.Name.Decorator: RGBColor(170, 51, 0),  # Warm orange - decorators
+        Token.Name.Builtin: RGBColor(0, 110, 71),  # Deep green - builtins
+        Token.String: RGBColor(196, 26, 22),  # Red - strings
+        Token.String.Doc: RGBColor(109, 120, 133),  # Gray - docstrings
+        Token.Comment: RGBColor(109, 120, 133),  # Gray - comments
+        Token.Comment.Single: RGBColor(109, 120, 133),
+        Token.Comment.Multiline: RGBColor(109, 120, 133),
+        Token.Number: RGBColor(28, 0, 207),  # Indigo - numbers
+        Token.Number.Integer: RGBColor(28, 0, 207),
+        Token.Number.Float: RGBColor(28, 0, 207),
+        Token.Operator: RGBColor(90, 99, 120),  # Gray-blue - operators
+        Token.Punctuation: RGBColor(0, 0, 0),  # Black - punctuation
+    }
+    _TOKEN_STYLE: Dict[Any, Tuple[Optional[RGBColor], bool]] = {}
 
-@dataclass(frozen=True)
-class _CitationRef:
+    def _token_style(token_type) -> Tuple[Optional[RGBColor], bool]:
+        """Resolve (color, bold) for a token type, memoized per type."""
+        style = _TOKEN_STYLE.get(token_type)
+        if style is not None:
+            return style
+        color = None
+        t = token_type
+        while t:
+            if t in _TOKEN_COLORS:
+                color = _TOKEN_COLORS[t]
+                break
+            t = t.parent
+        style = (color, token_type in Token.Keyword)
+        _TOKEN_STYLE[token_type] = style
+        return style
+
+    # Shared fallback for every unknown language name.
+    _TEXT_LEXER = TextLexer()
+    # Fence tags for unhighlighted output; Pygments would emit uncolored tokens.
+    _PLAIN_CODE_LANGUAGES = frozenset(
+        ("text", "txt", "plain", "plaintext", "log", "output", "raw")
+    )
+
+    @functools.lru_cache(maxsize=64)
+    def _get_lexer(name: str):
+        """Lexer for a lowercased alias; unknown and plain names share TextLexer."""
+        if name in _PLAIN_CODE_LANGUAGES:
+            return _TEXT_LEXER
+        try:
+            return get_lexer_by_name(name, stripall=False)
+        except Exception:
+            return _TEXT_LEXER
+if LATEX_MATH_AVAILABLE:
+
+    @functools.lru_cache(maxsize=4096)
+    def _latex_to_omml(latex: str) -> str:
+        """LaTeX -> MathML -> OMML; pure, so repeated expressions convert once."""
+        return mathml2omml.convert(latex_to_mathml(latex))
+
+    # Parsed OMML keyed by converter output; callers insert deepcopies, never these
+    # nodes, and a repeated equation skips the namespace fix-up and the parse.
+    @functools.lru_cache(maxsize=512)
+    def _parse_omath_para(omml: str):
+        """Display equation wrapped in oMathPara with its namespaces declared."""
+        return parse_xml("".join((_OMATH_PARA_OPEN, omml, "</m:oMathPara>")))
+
+    @functools.lru_cache(maxsize=512)
+    def _parse_omath(omml: str):
+        """Inline oMath element, declaring the math namespace if it is missing."""
+        s = (omml or "").strip()
+        if s.startswith("<m:oMath>") and s.endswith("</m:oMath>"):
+            s = _OMATH_OPEN_NS + s[len("<m:oMath>") :]
+        elif s.startswith("<m:oMath") and "xmlns:m=" not in s[: s.find(">")]:
+            s = _OMATH_OPEN_NS[: -len(">")] + s[len("<m:oMath") :]
+        return parse_xml(s)
+
+class _CitationRef(NamedTuple):
     idx: int
     anchor: str
     title: str
     url: Optional[str]
     source_id: str
 
+# Escapes a value for embedding inside a double-quoted JS string literal.
+_JS_ESCAPE = str.maketrans({"\\": "\\\\", '"': '\\"', "\n": "\\n", "\r": "\\r"})
+# Client-side export pipeline run via __event_call__ "execute": renders Mermaid
+# placeholders to SVG/PNG inside the DOCX and triggers the download. The payload is
+# _JS_TEMPLATE_HEAD + base64 DOCX + formatted _JS_MIDDLE + _JS_TEMPLATE_TAIL.
+# Documents without Mermaid diagrams use _JS_DOWNLOAD_ONLY_TAIL instead, which skips
+# loading Mermaid/JSZip and re-parsing the package.
+_JS_TEMPLATE_HEAD = '(async function() {\n    const base64Data = "'
+_JS_MIDDLE = """\
+";
+    const filename = "{filename}";
+    const mermaidUrl = "{mermaid_url}";
+    const jszipUrl = "{jszip_url}";
+    const pngScale = {png_scale};
+    const displayScale = {display_scale};
+    const bgRaw = "{background}";
+    const bg = (bgRaw || "").trim();
+    const bgFill = (bg && bg.toLowerCase() !== "transparent") ? bg : "";
+    const themeBackground = bgFill || "transparent";
+"""
+_JS_DOWNLOAD_ONLY_TAIL = """\
+    const binary = atob(base64Data);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++) bytes[i] = binary.charCodeAt(i);
+    const blob = new Blob([bytes], { type: "application/vnd.openxmlformats-officedocument.wordprocessingml.document" });
+    const url = URL.createObjectURL(blob);
+    const a = document.createElement("a");
+    a.style.display = "none";
+    a.href = url;
+    a.download = filename;
+    document.body.appendChild(a);
+    a.click();
+    URL.revokeObjectURL(url);
+    document.body.removeChild(a);
+})();
+"""
+_JS_TEMPLATE_TAIL = """\
+    // DOMParser/XMLSerializer/TextDecoder are stateless between calls; share one of each.
+    const parser = new DOMParser();
+    const serializer = new XMLSerializer();
+    const utf8Decoder = new TextDecoder("utf-8");
+    function downloadBlob(blob, filename) {
+        const url = URL.createObjectURL(blob);
+        const a = document.createElement("a");
+        a.style.display = "none";
+        a.href = url;
+        a.download = filename;
+        document.body.appendChild(a);
+        a.click();
+        URL.revokeObjectURL(url);
+        document.body.removeChild(a);
+    }
+    async function loadScript(url, globalName) {
+        if (globalName && window[globalName]) return;
+        await new Promise((resolve, reject) => {
+            const script = document.createElement("script");
+            script.src = url;
+            script.onload = resolve;
+            script.onerror = reject;
+            document.head.appendChild(script);
+        });
+    }
+    function decodeBase64ToUint8Array(b64) {
+        const binary = atob(b64);
+        const bytes = new Uint8Array(binary.length);
+        for (let i = 0; i < binary.length; i++) bytes[i] = binary.charCodeAt(i);
+        return bytes;
+    }
+    function parseViewBox(vb) {
+        if (!vb) return null;
+        const parts = vb.trim().split(/\\s+/).map(Number);
+        if (parts.length !== 4 || parts.some((n) => !isFinite(n))) return null;
+        return { minX: parts[0], minY: parts[1], width: parts[2], height: parts[3] };
+    }
+    // Returns the normalized SVG text together with its final viewBox, so callers
+    // need no second parse to size the drawing.
+    function normalizeSvgForWord(svgText) {
+        const doc = parser.parseFromString(svgText, "image/svg+xml");
+        const svgEl = doc.documentElement;
+        if (!svgEl || svgEl.tagName.toLowerCase() !== "svg") return { svgText, viewBox: null };
+        // Pad viewBox a little to reduce clipping in Word.
+        const vb0 = parseViewBox(svgEl.getAttribute("viewBox"));
+        if (vb0 && vb0.width > 0 && vb0.height > 0) {
+            const minDim = Math.min(vb0.width, vb0.height);
+            let pad = Math.max(8.0, minDim * 0.02);
+            pad = Math.min(pad, 24.0);
+            const vb = {
+                minX: vb0.minX - pad,
+                minY: vb0.minY - pad,
+                width: vb0.width + 2 * pad,
+                height: vb0.height + 2 * pad,
+            };
+            svgEl.setAttribute("viewBox", `${vb.minX} ${vb.minY} ${vb.width} ${vb.height}`);
+        }
+        const vb = parseViewBox(svgEl.getAttribute("viewBox"));
+        const widthAttr = (svgEl.getAttribute("width") || "").trim();
+        const heightAttr = (svgEl.getAttribute("height") || "").trim();
+        const widthPct = widthAttr.endsWith("%");
+        const heightPct = heightAttr.endsWith("%");
+        if (vb && vb.width > 0 && vb.height > 0 && (!widthAttr || !heightAttr || widthPct || heightPct)) {
+            svgEl.setAttribute("width", `${vb.width}`);
+            svgEl.setAttribute("height", `${vb.height}`);
+        }
+        svgEl.removeAttribute("style");
+        svgEl.setAttribute("preserveAspectRatio", "xMidYMid meet");
+        svgEl.setAttribute("overflow", "visible");
+        const removeNode = (n) => {
+            try { n && n.parentNode && n.parentNode.removeChild(n); } catch (_e) {}
+        };
+        // Remove Mermaid/OWUI background rectangles to avoid \"white box\" rendering in Word dark mode.
+        svgEl
+            .querySelectorAll('rect[data-owui-bg=\"1\"], rect.background, rect[class~=\"background\"], rect#background')
+            .forEach(removeNode);
+        try {
+            const isWhiteish = (fill) => {
+                const f = (fill || "").trim().toLowerCase();
+                return (
+                    f === "white" ||
+                    f === "#fff" ||
+                    f === "#ffffff" ||
+                    f === "rgb(255,255,255)" ||
+                    f === "rgb(255, 255, 255)"
+                );
+            };
+            const nearly = (a, b) => Math.abs(a - b) <= 1e-3;
+            const rectMatches = (r, box) => {
+                if (!box) return false;
+                const x = parseFloat(r.getAttribute("x") || "0");
+                const y = parseFloat(r.getAttribute("y") || "0");
+                const w = parseFloat(r.getAttribute("width") || "");
+                const h = parseFloat(r.getAttribute("height") || "");
+                if (!isFinite(x) || !isFinite(y) || !isFinite(w) || !isFinite(h)) return false;
+                return (
+                    nearly(x, box.minX) &&
+                    nearly(y, box.minY) &&
+                    nearly(w, box.width) &&
+                    nearly(h, box.height)
+                );
+            };
+            const vbNow = parseViewBox(svgEl.getAttribute("viewBox"));
+            svgEl.querySelectorAll("rect[fill]").forEach((r) => {
+                const fill = r.getAttribute("fill");
+                if (!isWhiteish(fill)) return;
+                if (rectMatches(r, vb0) || rectMatches(r, vbNow)) removeNode(r);
+            });
+        } catch (_e) {}
+        try {
+            const vbCanvas = parseViewBox(svgEl.getAttribute(\"viewBox\")) || vb0 || vb;
+            if (vbCanvas) {
+                const existing = svgEl.querySelector('rect[data-owui-canvas=\"1\"]');
+                const rect = existing || doc.createElementNS(\"http://www.w3.org/2000/svg\", \"rect\");
+                rect.setAttribute(\"data-owui-canvas\", \"1\");
+                rect.setAttribute(\"x\", `${vbCanvas.minX}`);
+                rect.setAttribute(\"y\", `${vbCanvas.minY}`);
+                rect.setAttribute(\"width\", `${vbCanvas.width}`);
+                rect.setAttribute(\"height\", `${vbCanvas.height}`);
+                rect.setAttribute(\"fill\", \"#FFFFFF\");
+                // Word quirk: without a full-canvas rect with *non-zero* opacity, Word will often
+                // only offer \"Convert to Shape\" when clicking on an actual stroke/fill (not empty space).
+                // We keep this rect nearly transparent and non-interactive.
+                rect.setAttribute(\"fill-opacity\", \"0.001\");
+                rect.setAttribute(\"stroke\", \"none\");
+                rect.setAttribute(\"stroke-opacity\", \"0\");
+                rect.setAttribute(\"pointer-events\", \"none\");
+                if (!existing) {
+                    const first = svgEl.firstChild;
+                    svgEl.insertBefore(rect, first);
+                }
+            }
+        } catch (_e) {}
+        return {
+            svgText: serializer.serializeToString(svgEl),
+            viewBox: parseViewBox(svgEl.getAttribute("viewBox")),
+        };
+    }
+    function getMaxWidthEmu(xmlDoc) {
+        try {
+            const sects = xmlDoc.getElementsByTagName("w:sectPr");
+            const sect = sects && sects.length ? sects[sects.length - 1] : null;
+            if (!sect) return 5486400; // 6 in
+            const pgSz = sect.getElementsByTagName("w:pgSz")[0];
+            const pgMar = sect.getElementsByTagName("w:pgMar")[0];
+            if (!pgSz || !pgMar) return 5486400;
+            const pageW = parseInt(pgSz.getAttribute("w:w") || "", 10);
+            const left = parseInt(pgMar.getAttribute("w:left") || "", 10);
+            const right = parseInt(pgMar.getAttribute("w:right") || "", 10);
+            if (!isFinite(pageW) || !isFinite(left) || !isFinite(right)) return 5486400;
+            const twips = Math.max(1, pageW - left - right);
+            return Math.round(twips * 635); // 1 twip = 635 EMU
+        } catch (_e) {
+            return 5486400;
+        }
+    }
+    try {
+        await loadScript(jszipUrl, "JSZip");
+        await loadScript(mermaidUrl, "mermaid");
+        // Mermaid init: disable htmlLabels to keep SVG Word-friendly; PNG fallback still included.
+        try {
+            window.mermaid.initialize({
+                startOnLoad: false,
+                theme: "default",
+                themeVariables: {
+                    background: themeBackground,
+                    fontFamily: "Calibri, Segoe UI, Arial, sans-serif",
+                    fontSize: "10pt",
+                },
+                themeCSS: ".slice { font-size: 10pt !important; }\\n.legend text { font-size: 10pt !important; }\\n.pieTitleText { font-size: 10pt !important; }",
+                fontFamily: "Calibri, Segoe UI, Arial, sans-serif",
+                securityLevel: "strict",
+                flowchart: { htmlLabels: false },
+            });
+        } catch (_e) {
+            // Ignore and proceed with defaults.
+        }
+        const bytes = decodeBase64ToUint8Array(base64Data);
+        const zip = new window.JSZip();
+        await zip.loadAsync(bytes);
+        // Inflate both parts concurrently and decode natively; JSZip's own UTF-8 decoder is slower.
+        const [docBytes, relsBytes] = await Promise.all([
+            zip.file("word/document.xml").async("uint8array"),
+            zip.file("word/_rels/document.xml.rels").async("uint8array"),
+        ]);
+        const docXml = utf8Decoder.decode(docBytes);
+        const relsXml = utf8Decoder.decode(relsBytes);
+        const xmlDoc = parser.parseFromString(docXml, "application/xml");
+        const relsDoc = parser.parseFromString(relsXml, "application/xml");
+        // Build rId -> target path mapping
+        // Snapshot the live collections once; null-prototype map so ids never hit Object.prototype.
+        const rIdToTarget = Object.create(null);
+        for (const rel of Array.from(relsDoc.getElementsByTagName("Relationship"))) {
+            const id = rel.getAttribute("Id");
+            const target = rel.getAttribute("Target");
+            if (id && target) rIdToTarget[id] = target;
+        }
+        const maxWidthEmu = getMaxWidthEmu(xmlDoc);
+        const maxWidthEmuScaled = Math.max(1, Math.round(maxWidthEmu * Math.min(1.0, Math.max(0.1, displayScale || 1.0))));
+        const placeholders = [];
+        for (const drawing of Array.from(xmlDoc.getElementsByTagName("w:drawing"))) {
+            // Single descent per drawing collecting every node of interest.
+            const walker = xmlDoc.createTreeWalker(drawing, NodeFilter.SHOW_ELEMENT);
+            let docPr = null, blip = null, svgBlip = null, extent = null, xfrmExt = null;
+            let descr = "";
+            while (walker.nextNode()) {
+                const node = walker.currentNode;
+                const parentName = node.parentNode ? node.parentNode.nodeName : "";
+                switch (node.nodeName) {
+                    case "wp:docPr":
+                        if (!docPr) {
+                            docPr = node;
+                            descr = node.getAttribute("descr") || "";
+                        }
+                        break;
+                    case "a:blip":
+                        if (!blip) blip = node;
+                        break;
+                    case "asvg:svgBlip":
+                        if (!svgBlip) svgBlip = node;
+                        break;
+                    case "wp:extent":
+                        if (!extent && (parentName === "wp:inline" || parentName === "wp:anchor")) extent = node;
+                        break;
+                    case "a:ext":
+                        if (!xfrmExt && parentName === "a:xfrm") xfrmExt = node;
+                        break;
+                }
+                // Not a Mermaid placeholder: stop descending this drawing.
+                if (docPr && !descr.startsWith("MERMAID_SRC:")) break;
+            }
+            if (!docPr || !descr.startsWith("MERMAID_SRC:")) continue;
+            const encoded = descr.substring("MERMAID_SRC:".length);
+            const code = decodeURIComponent(encoded);
+            const ridPng = blip ? blip.getAttribute("r:embed") : null;
+            const ridSvg = svgBlip ? svgBlip.getAttribute("r:embed") : null;
+            placeholders.push({ code, ridPng, ridSvg, extent, xfrmExt, svgBlip });
+        }
+        if (!placeholders.length) {
+            const blob = new Blob([bytes], { type: "application/vnd.openxmlformats-officedocument.wordprocessingml.document" });
+            downloadBlob(blob, filename);
+            return;
+        }
+        // Run fn over items with at most `limit` calls in flight; results keep item order.
+        async function mapWithLimit(items, limit, fn) {
+            const results = new Array(items.length);
+            let next = 0;
+            async function worker() {
+                while (next < items.length) {
+                    const i = next++;
+                    results[i] = await fn(items[i], i);
+                }
+            }
+            const workers = [];
+            for (let w = 0; w < Math.min(limit, items.length); w++) workers.push(worker());
+            await Promise.all(workers);
+            return results;
+        }
+        // Phase 1: Render all Mermaid diagrams with bounded concurrency. Mermaid queues
+        // render() calls internally, so overlapping them is safe; it lets the SVG
+        // normalization of finished diagrams overlap with pending renders.
+        const renderResults = await mapWithLimit(placeholders, 4, async (item, i) => {
+            try {
+                const id = "owui-mermaid-" + i;
+                const rendered = await window.mermaid.render(id, item.code);
+                let svgText = rendered && rendered.svg ? rendered.svg : rendered;
+                if (!svgText || typeof svgText !== "string") throw new Error("Mermaid returned empty SVG");
+                const normalized = normalizeSvgForWord(svgText);
+                svgText = normalized.svgText;
+                const hasForeignObject = /<foreignObject\\b/i.test(svgText);
+                if (hasForeignObject && item.svgBlip) {
+                    try { item.svgBlip.parentNode && item.svgBlip.parentNode.removeChild(item.svgBlip); } catch (_e) {}
+                    item.ridSvg = null;
+                }
+                const vb = normalized.viewBox;
+                const ratio = vb && vb.width > 0 && vb.height > 0 ? (vb.width / vb.height) : (4/3);
+                const widthEmu = maxWidthEmuScaled;
+                const heightEmu = Math.max(1, Math.round(widthEmu / ratio));
+                return { item, svgText, widthEmu, heightEmu, success: true };
+            } catch (err) {
+                console.error("Mermaid render failed for block", i, err);
+                return { item, svgText: null, widthEmu: 0, heightEmu: 0, success: false };
+            }
+        });
+        // Phase 2: Convert SVG to PNG in parallel for performance
+        // SVG goes in via an <img> (Chrome cannot decode SVG blobs with
+        // createImageBitmap); returns raw PNG bytes for zip.file().
+        async function svgToPng(svgText, targetWidthPx, targetHeightPx) {
+            const scale = Math.max(1.0, pngScale || 1.0);
+            const width = Math.round(targetWidthPx * scale);
+            const height = Math.round(targetHeightPx * scale);
+            const canvas = document.createElement("canvas");
+            const ctx = canvas.getContext("2d");
+            canvas.width = width;
+            canvas.height = height;
+            ctx.setTransform(1, 0, 0, 1, 0, 0);
+            if (bgFill) {
+                ctx.fillStyle = bgFill;
+                ctx.fillRect(0, 0, canvas.width, canvas.height);
+            }
+            ctx.scale(scale, scale);
+            const img = new Image();
+            const svgUrl = URL.createObjectURL(new Blob([svgText], { type: "image/svg+xml" }));
+            try {
+                await new Promise((resolve, reject) => {
+                    img.onload = resolve;
+                    img.onerror = reject;
+                    img.src = svgUrl;
+                });
+                ctx.drawImage(img, 0, 0, targetWidthPx, targetHeightPx);
+            } finally {
+                URL.revokeObjectURL(svgUrl);
+            }
+            const pngBlob = await new Promise((resolve, reject) => {
+                canvas.toBlob((b) => (b ? resolve(b) : reject(new Error("canvas.toBlob failed"))), "image/png");
+            });
+            return new Uint8Array(await pngBlob.arrayBuffer());
+        }
+        // Create PNG conversion promises for parallel execution
+        const pngPromises = renderResults.map(async (result, i) => {
+            if (!result.success || !result.svgText) return null;
+            const { item, widthEmu, heightEmu } = result;
+            if (!item.ridPng || !rIdToTarget[item.ridPng]) return null;
+            
+            const targetWidthPx = Math.max(1, Math.round(widthEmu / 9525));
+            const targetHeightPx = Math.max(1, Math.round(heightEmu / 9525));
+            
+            try {
+                const pngBytes = await svgToPng(result.svgText, targetWidthPx, targetHeightPx);
+                return { index: i, pngBytes, path: "word/" + rIdToTarget[item.ridPng] };
+            } catch (err) {
+                console.error("PNG conversion failed for block", i, err);
+                return null;
+            }
+        });
+        // Wait for all PNG conversions to complete
+        const pngResults = await Promise.all(pngPromises);
+        // Rewritten XML/SVG parts are deflated at a cheaper level than the default (6);
+        // PNG data is already zlib-compressed, so deflating it again only costs CPU.
+        const textZipOptions = { compression: "DEFLATE", compressionOptions: { level: 3 } };
+        const pngZipOptions = { binary: true, compression: "STORE" };
+        // Phase 3: Update ZIP with all results. Size the drawings first, then write the
+        // SVG parts in a separate pass so XML edits and zip writes are not interleaved.
+        const mutations = [];
+        const svgWrites = [];
+        for (let i = 0; i < renderResults.length; i++) {
+            const result = renderResults[i];
+            if (!result.success) continue;
+            const { item, svgText, widthEmu, heightEmu } = result;
+            const cx = `${widthEmu}`;
+            const cy = `${heightEmu}`;
+            if (item.extent) mutations.push({ node: item.extent, cx, cy });
+            if (item.xfrmExt) mutations.push({ node: item.xfrmExt, cx, cy });
+            if (item.ridSvg && rIdToTarget[item.ridSvg]) {
+                svgWrites.push(["word/" + rIdToTarget[item.ridSvg], svgText]);
+            }
+        }
+        for (const m of mutations) {
+            m.node.setAttribute("cx", m.cx);
+            m.node.setAttribute("cy", m.cy);
+        }
+        for (const [path, svgText] of svgWrites) {
+            zip.file(path, svgText, textZipOptions);
+        }
+        // Write PNG files from parallel results
+        for (const pngResult of pngResults) {
+            if (pngResult && pngResult.pngBytes) {
+                zip.file(pngResult.path, pngResult.pngBytes, pngZipOptions);
+            }
+        }
+        const newDocXml = serializer.serializeToString(xmlDoc);
+        zip.file("word/document.xml", newDocXml, textZipOptions);
+        // Unchanged entries keep their original compressed data; only rewritten parts
+        // carry their own per-file options above.
+        const finalBlob = await zip.generateAsync({ type: "blob", ...textZipOptions });
+        downloadBlob(finalBlob, filename);
+    } catch (error) {
+        console.error("Export pipeline failed:", error);
+        const bytes = decodeBase64ToUint8Array(base64Data);
+        const blob = new Blob([bytes], { type: "application/vnd.openxmlformats-officedocument.wordprocessingml.document" });
+        downloadBlob(blob, filename);
+    }
+})();
+"""
+
 class Action:
     # Internationalization message dictionaries
     _I18N_MESSAGES: Dict[str, Dict[str, str]] = {
@@ -266,21 +1109,34 @@ class Action:
         self._mermaid_figure_counter: int = 0
         self._mermaid_placeholder_counter: int = 0
         self._caption_style_name: Optional[str] = None
-        self._citation_anchor_by_index: Dict[int, str] = {}
+        self._citation_ref_by_index: Dict[int, _CitationRef] = {}
         self._citation_refs: List[_CitationRef] = []
         self._bookmark_id_counter: int = 1
         self._active_doc: Optional[Document] = None
         self._user_lang: str = "en"  # Will be set per-request
+        self._msgs: Dict[str, str] = dict(self._I18N_MESSAGES["en"])
         self._api_token: Optional[str] = None
         self._api_base_url: Optional[str] = None
+        self._prefetched_file_bytes: Dict[str, Optional[bytes]] = {}
+        self._prefetched_data_url_bytes: Dict[str, Optional[bytes]] = {}
+        # (blake2b digest, width) -> (story part, rId, filename, cx, cy) of images
+        # already embedded in this export.
+        self._embedded_images: Dict[
+            Tuple[bytes, Any], Tuple[Any, str, str, int, int]
+        ] = {}
+        # s3:// paths that already failed or were too large during this export.
+        self._failed_s3_paths: set = set()
+        # (raw MAX_EMBED_IMAGE_MB valve value, byte limit derived from it)
+        self._max_embed_image_bytes_cache: Optional[Tuple[Any, int]] = None
+        # (chat_id, user_id) -> (monotonic expiry, title)
+        self._chat_title_cache: Dict[Tuple[str, str], Tuple[float, str]] = {}
     def _get_lang_key(self, user_language: str) -> str:
         """Convert user language code to i18n key (e.g., 'zh-CN' -> 'zh', 'en-US' -> 'en')."""
         lang = (user_language or "en").lower().split("-")[0]
         return lang if lang in self._I18N_MESSAGES else "en"
     def _get_msg(self, key: str, **kwargs) -> str:
         """Get internationalized message by key with optional formatting."""
-        messages = self._I18N_MESSAGES.get(self._user_lang, self._I18N_MESSAGES["en"])
-        msg = messages.get(key, self._I18N_MESSAGES["en"].get(key, key))
+        msg = self._msgs.get(key, key)
         if kwargs:
             try:
                 return msg.format(**kwargs)
@@ -290,7 +1146,7 @@ class Action:
     def _get_user_context(self, __user__: Optional[Dict[str, Any]]) -> Dict[str, str]:
         """Safely extracts user context information."""
         if isinstance(__user__, (list, tuple)):
-            user_data = __user__[0] if __user__ else {}
+            user_data = (__user__[0] if __user__ else None) or {}
         elif isinstance(__user__, dict):
             user_data = __user__
         else:
@@ -361,7 +1217,7 @@ class Action:
             import json
             js_code = f"""
                 (async function() {{
-                    console.group("🛠️ {title}");
+                    console.group("🛠️ {title.translate(_JS_ESCAPE)}");
                     console.log({json.dumps(data, ensure_ascii=False)});
                     console.groupEnd();
                 }})();
@@ -369,6 +1225,23 @@ class Action:
             await emitter({"type": "execute", "data": {"code": js_code}})
         except Exception as e:
             print(f"Error emitting debug log: {e}")
+    def _docx_base64_chunks(self, doc: Document) -> List[str]:
+        """
+        Save the document and return its base64 encoding as a list of chunks.
+        The DOCX is spooled to a temporary file (in memory up to 8MB) and encoded
+        in 3-byte-aligned blocks, so the full file and its base64 text are never
+        held as two complete copies at once.
+        """
+        chunks: List[str] = []
+        with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as tmp:
+            doc.save(tmp)
+            tmp.seek(0)
+            while True:
+                block = tmp.read(57 * 4096)
+                if not block:
+                    break
+                chunks.append(_b64encode(block).decode("ascii"))
+        return chunks
     async def action(
         self,
         body: dict,
@@ -380,18 +1253,9 @@ class Action:
     ):
         logger.info(f"action:{__name__}")
         # Parse user info
-        user_name = "User"
-        user_id = "unknown_user"
-        if isinstance(__user__, (list, tuple)):
-            user_name = __user__[0].get("name", "User") if __user__[0] else "User"
-            user_id = (
-                __user__[0]["id"]
-                if __user__ and "id" in __user__[0]
-                else "unknown_user"
-            )
-        elif isinstance(__user__, dict):
-            user_name = __user__.get("name", "User")
-            user_id = __user__.get("id", "unknown_user")
+        user_ctx = self._get_user_context(__user__)
+        user_name = user_ctx["user_name"]
+        user_id = user_ctx["user_id"]
         # Apply UserValves if present
         if __user__ and "valves" in __user__:
             # Update self.valves with user-specific values
@@ -402,6 +1266,11 @@ class Action:
                     setattr(self.valves, key, value)
         # Get user language from Valves configuration
         self._user_lang = self._get_lang_key(self.valves.UI_LANGUAGE)
+        # Resolve the message table once, with English as the per-key fallback
+        self._msgs = {
+            **self._I18N_MESSAGES["en"],
+            **self._I18N_MESSAGES.get(self._user_lang, {}),
+        }
         # Extract API connection info for file fetching (S3/Object Storage support)
         def _get_default_base_url() -> str:
             port = os.environ.get("PORT") or "8080"
@@ -440,26 +1309,28 @@ class Action:
                 title = ""
                 chat_ctx = self._get_chat_context(body, __metadata__)
                 chat_id = chat_ctx["chat_id"]
+                title_source = self.valves.TITLE_SOURCE.strip()
                 # Fetch chat_title directly via chat_id as it's usually missing in body
-                chat_title = ""
-                if chat_id:
-                    chat_title = await self.fetch_chat_title(chat_id, user_id)
-                if (
-                    self.valves.TITLE_SOURCE.strip() == "chat_title"
-                    or not self.valves.TITLE_SOURCE.strip()
-                ):
-                    title = chat_title
-                elif self.valves.TITLE_SOURCE.strip() == "markdown_title":
-                    title = self.extract_title(message_content)
-                elif self.valves.TITLE_SOURCE.strip() == "ai_generated":
-                    title = await self.generate_title_using_ai(
-                        body, message_content, user_id, __request__
+                if title_source == "ai_generated":
+                    # The chat title is still needed for the top heading/fallback;
+                    # fetch it while the model generates the title.
+                    chat_title, title = await asyncio.gather(
+                        self.fetch_chat_title(chat_id, user_id),
+                        self.generate_title_using_ai(
+                            body, message_content, user_id, __request__
+                        ),
                     )
+                else:
+                    chat_title = await self.fetch_chat_title(chat_id, user_id)
+                    if title_source == "chat_title" or not title_source:
+                        title = chat_title
+                    elif title_source == "markdown_title":
+                        title = self.extract_title(message_content)
                 # Fallback logic
                 if not title:
-                    if self.valves.TITLE_SOURCE.strip() != "chat_title" and chat_title:
+                    if title_source != "chat_title" and chat_title:
                         title = chat_title
-                    elif self.valves.TITLE_SOURCE.strip() != "markdown_title":
+                    elif title_source != "markdown_title":
                         extracted = self.extract_title(message_content)
                         if extracted:
                             title = extracted
@@ -472,14 +1343,14 @@ class Action:
                     clean_user = self.clean_filename(user_name)
                     filename = f"{clean_user}_{formatted_date}.docx"
                 # Escape filename for JS string
-                js_filename = filename.replace("\\", "\\\\").replace('"', '\\"')
+                js_filename = filename.translate(_JS_ESCAPE)
                 top_heading = ""
                 if chat_title:
                     top_heading = chat_title
                 elif title:
                     top_heading = title
                 # Create Word document; if no h1 exists, inject chat title as h1
-                has_h1 = bool(re.search(r"^#\s+.+$", message_content, re.MULTILINE))
+                has_h1 = bool(_H1_RE.search(message_content))
                 sources = (
                     last_assistant_message.get("sources") or body.get("sources") or []
                 )
@@ -490,359 +1361,39 @@ class Action:
                     sources=sources,
                     event_emitter=__event_emitter__,
                 )
-                # Save to memory
-                doc_buffer = io.BytesIO()
-                doc.save(doc_buffer)
-                doc_buffer.seek(0)
-                file_content = doc_buffer.read()
-                base64_blob = base64.b64encode(file_content).decode("utf-8")
+                # Serialize and base64-encode in chunks (spills to disk for large files)
+                base64_chunks = self._docx_base64_chunks(doc)
+                # Release the python-docx/lxml tree before building the JS payload.
+                del doc
+                js_settings = _JS_MIDDLE.format(
+                    filename=js_filename,
+                    mermaid_url=self.valves.MERMAID_JS_URL.translate(_JS_ESCAPE),
+                    jszip_url=self.valves.MERMAID_JSZIP_URL.translate(_JS_ESCAPE),
+                    png_scale=float(self.valves.MERMAID_PNG_SCALE),
+                    display_scale=float(self.valves.MERMAID_DISPLAY_SCALE),
+                    background=(self.valves.MERMAID_BACKGROUND or "")
+                    .strip()
+                    .translate(_JS_ESCAPE),
+                )
+                js_tail = (
+                    _JS_TEMPLATE_TAIL
+                    if self._mermaid_placeholder_counter
+                    else _JS_DOWNLOAD_ONLY_TAIL
+                )
                 # Trigger file download
                 if __event_call__:
                     await __event_call__(
                         {
                             "type": "execute",
                             "data": {
-                                "code": f"""
-                                (async function() {{
-                                    const base64Data = "{base64_blob}";
-                                    const filename = "{js_filename}";
-	                                    const mermaidUrl = "{self.valves.MERMAID_JS_URL}";
-	                                    const jszipUrl = "{self.valves.MERMAID_JSZIP_URL}";
-	                                    const pngScale = {float(self.valves.MERMAID_PNG_SCALE)};
-	                                    const displayScale = {float(self.valves.MERMAID_DISPLAY_SCALE)};
-	                                    const bgRaw = "{(self.valves.MERMAID_BACKGROUND or '').strip()}";
-	                                    const bg = (bgRaw || "").trim();
-	                                    const bgFill = (bg && bg.toLowerCase() !== "transparent") ? bg : "";
-	                                    const themeBackground = bgFill || "transparent";
-                                    function downloadBlob(blob, filename) {{
-                                        const url = URL.createObjectURL(blob);
-                                        const a = document.createElement("a");
-                                        a.style.display = "none";
-                                        a.href = url;
-                                        a.download = filename;
-                                        document.body.appendChild(a);
-                                        a.click();
-                                        URL.revokeObjectURL(url);
-                                        document.body.removeChild(a);
-                                    }}
-                                    async function loadScript(url, globalName) {{
-                                        if (globalName && window[globalName]) return;
-                                        await new Promise((resolve, reject) => {{
-                                            const script = document.createElement("script");
-                                            script.src = url;
-                                            script.onload = resolve;
-                                            script.onerror = reject;
-                                            document.head.appendChild(script);
-                                        }});
-                                    }}
-                                    function decodeBase64ToUint8Array(b64) {{
-                                        const binary = atob(b64);
-                                        const bytes = new Uint8Array(binary.length);
-                                        for (let i = 0; i < binary.length; i++) bytes[i] = binary.charCodeAt(i);
-                                        return bytes;
-                                    }}
-                                    function parseViewBox(vb) {{
-                                        if (!vb) return null;
-                                        const parts = vb.trim().split(/\\s+/).map(Number);
-                                        if (parts.length !== 4 || parts.some((n) => !isFinite(n))) return null;
-                                        return {{ minX: parts[0], minY: parts[1], width: parts[2], height: parts[3] }};
-                                    }}
-	                                    function normalizeSvgForWord(svgText) {{
-	                                        const parser = new DOMParser();
-	                                        const doc = parser.parseFromString(svgText, "image/svg+xml");
-	                                        const svgEl = doc.documentElement;
-	                                        if (!svgEl || svgEl.tagName.toLowerCase() !== "svg") return svgText;
-                                        // Pad viewBox a little to reduce clipping in Word.
-                                        const vb0 = parseViewBox(svgEl.getAttribute("viewBox"));
-                                        if (vb0 && vb0.width > 0 && vb0.height > 0) {{
-                                            const minDim = Math.min(vb0.width, vb0.height);
-                                            let pad = Math.max(8.0, minDim * 0.02);
-                                            pad = Math.min(pad, 24.0);
-                                            const vb = {{
-                                                minX: vb0.minX - pad,
-                                                minY: vb0.minY - pad,
-                                                width: vb0.width + 2 * pad,
-                                                height: vb0.height + 2 * pad,
-                                            }};
-                                            svgEl.setAttribute("viewBox", `${{vb.minX}} ${{vb.minY}} ${{vb.width}} ${{vb.height}}`);
-                                        }}
-                                        const vb = parseViewBox(svgEl.getAttribute("viewBox"));
-                                        const widthAttr = (svgEl.getAttribute("width") || "").trim();
-                                        const heightAttr = (svgEl.getAttribute("height") || "").trim();
-                                        const widthPct = widthAttr.endsWith("%");
-                                        const heightPct = heightAttr.endsWith("%");
-                                        if (vb && vb.width > 0 && vb.height > 0 && (!widthAttr || !heightAttr || widthPct || heightPct)) {{
-                                            svgEl.setAttribute("width", `${{vb.width}}`);
-                                            svgEl.setAttribute("height", `${{vb.height}}`);
-                                        }}
-	                                        svgEl.removeAttribute("style");
-	                                        svgEl.setAttribute("preserveAspectRatio", "xMidYMid meet");
-		                                        svgEl.setAttribute("overflow", "visible");
-		                                        const removeNode = (n) => {{
-		                                            try {{ n && n.parentNode && n.parentNode.removeChild(n); }} catch (_e) {{}}
-		                                        }};
-		                                        // Remove Mermaid/OWUI background rectangles to avoid \"white box\" rendering in Word dark mode.
-		                                        svgEl
-		                                            .querySelectorAll('rect[data-owui-bg=\"1\"], rect.background, rect[class~=\"background\"], rect#background')
-		                                            .forEach(removeNode);
-		                                        try {{
-		                                            const isWhiteish = (fill) => {{
-		                                                const f = (fill || "").trim().toLowerCase();
-	                                                return (
-	                                                    f === "white" ||
-	                                                    f === "#fff" ||
-	                                                    f === "#ffffff" ||
-	                                                    f === "rgb(255,255,255)" ||
-	                                                    f === "rgb(255, 255, 255)"
-	                                                );
-	                                            }};
-	                                            const nearly = (a, b) => Math.abs(a - b) <= 1e-3;
-	                                            const rectMatches = (r, box) => {{
-	                                                if (!box) return false;
-	                                                const x = parseFloat(r.getAttribute("x") || "0");
-	                                                const y = parseFloat(r.getAttribute("y") || "0");
-	                                                const w = parseFloat(r.getAttribute("width") || "");
-	                                                const h = parseFloat(r.getAttribute("height") || "");
-	                                                if (!isFinite(x) || !isFinite(y) || !isFinite(w) || !isFinite(h)) return false;
-	                                                return (
-	                                                    nearly(x, box.minX) &&
-	                                                    nearly(y, box.minY) &&
-	                                                    nearly(w, box.width) &&
-	                                                    nearly(h, box.height)
-	                                                );
-		                                            }};
-		                                            const vbNow = parseViewBox(svgEl.getAttribute("viewBox"));
-		                                            svgEl.querySelectorAll("rect[fill]").forEach((r) => {{
-		                                                const fill = r.getAttribute("fill");
-		                                                if (!isWhiteish(fill)) return;
-		                                                if (rectMatches(r, vb0) || rectMatches(r, vbNow)) removeNode(r);
-		                                            }});
-		                                        }} catch (_e) {{}}
-		                                        try {{
-		                                            const vbCanvas = parseViewBox(svgEl.getAttribute(\"viewBox\")) || vb0 || vb;
-		                                            if (vbCanvas) {{
-		                                                const existing = svgEl.querySelector('rect[data-owui-canvas=\"1\"]');
-		                                                const rect = existing || doc.createElementNS(\"http://www.w3.org/2000/svg\", \"rect\");
-		                                                rect.setAttribute(\"data-owui-canvas\", \"1\");
-		                                                rect.setAttribute(\"x\", `${{vbCanvas.minX}}`);
-		                                                rect.setAttribute(\"y\", `${{vbCanvas.minY}}`);
-		                                                rect.setAttribute(\"width\", `${{vbCanvas.width}}`);
-		                                                rect.setAttribute(\"height\", `${{vbCanvas.height}}`);
-		                                                rect.setAttribute(\"fill\", \"#FFFFFF\");
-		                                                // Word quirk: without a full-canvas rect with *non-zero* opacity, Word will often
-		                                                // only offer \"Convert to Shape\" when clicking on an actual stroke/fill (not empty space).
-		                                                // We keep this rect nearly transparent and non-interactive.
-		                                                rect.setAttribute(\"fill-opacity\", \"0.001\");
-		                                                rect.setAttribute(\"stroke\", \"none\");
-		                                                rect.setAttribute(\"stroke-opacity\", \"0\");
-		                                                rect.setAttribute(\"pointer-events\", \"none\");
-		                                                if (!existing) {{
-		                                                    const first = svgEl.firstChild;
-		                                                    svgEl.insertBefore(rect, first);
-		                                                }}
-		                                            }}
-		                                        }} catch (_e) {{}}
-		                                        return new XMLSerializer().serializeToString(svgEl);
-		                                    }}
-                                    function getMaxWidthEmu(xmlDoc) {{
-                                        try {{
-                                            const sects = xmlDoc.getElementsByTagName("w:sectPr");
-                                            const sect = sects && sects.length ? sects[sects.length - 1] : null;
-                                            if (!sect) return 5486400; // 6 in
-                                            const pgSz = sect.getElementsByTagName("w:pgSz")[0];
-                                            const pgMar = sect.getElementsByTagName("w:pgMar")[0];
-                                            if (!pgSz || !pgMar) return 5486400;
-                                            const pageW = parseInt(pgSz.getAttribute("w:w") || "", 10);
-                                            const left = parseInt(pgMar.getAttribute("w:left") || "", 10);
-                                            const right = parseInt(pgMar.getAttribute("w:right") || "", 10);
-                                            if (!isFinite(pageW) || !isFinite(left) || !isFinite(right)) return 5486400;
-                                            const twips = Math.max(1, pageW - left - right);
-                                            return Math.round(twips * 635); // 1 twip = 635 EMU
-                                        }} catch (_e) {{
-                                            return 5486400;
-                                        }}
-                                    }}
-                                    function getChildByTag(parent, tag) {{
-                                        const nodes = parent.getElementsByTagName(tag);
-                                        return nodes && nodes.length ? nodes[0] : null;
-                                    }}
-                                    try {{
-                                        await loadScript(jszipUrl, "JSZip");
-                                        await loadScript(mermaidUrl, "mermaid");
-                                        // Mermaid init: disable htmlLabels to keep SVG Word-friendly; PNG fallback still included.
-	                                        try {{
-		                                            window.mermaid.initialize({{
-		                                                startOnLoad: false,
-		                                                theme: "default",
-			                                                themeVariables: {{
-			                                                    background: themeBackground,
-			                                                    fontFamily: "Calibri, Segoe UI, Arial, sans-serif",
-			                                                    fontSize: "10pt",
-			                                                }},
-			                                                themeCSS: ".slice {{ font-size: 10pt !important; }}\\n.legend text {{ font-size: 10pt !important; }}\\n.pieTitleText {{ font-size: 10pt !important; }}",
-			                                                fontFamily: "Calibri, Segoe UI, Arial, sans-serif",
-			                                                securityLevel: "strict",
-			                                                flowchart: {{ htmlLabels: false }},
-			                                            }});
-	                                        }} catch (_e) {{
-                                            // Ignore and proceed with defaults.
-                                        }}
-                                        const bytes = decodeBase64ToUint8Array(base64Data);
-                                        const zip = new window.JSZip();
-                                        await zip.loadAsync(bytes);
-                                        const docXml = await zip.file("word/document.xml").async("string");
-                                        const relsXml = await zip.file("word/_rels/document.xml.rels").async("string");
-                                        const parser = new DOMParser();
-                                        const xmlDoc = parser.parseFromString(docXml, "application/xml");
-                                        const relsDoc = parser.parseFromString(relsXml, "application/xml");
-                                        // Build rId -> target path mapping
-                                        const rels = relsDoc.getElementsByTagName("Relationship");
-                                        const rIdToTarget = {{}};
-                                        for (let i = 0; i < rels.length; i++) {{
-                                            const rel = rels[i];
-                                            const id = rel.getAttribute("Id");
-                                            const target = rel.getAttribute("Target");
-                                            if (id && target) rIdToTarget[id] = target;
-                                        }}
-                                        const maxWidthEmu = getMaxWidthEmu(xmlDoc);
-                                        const maxWidthEmuScaled = Math.max(1, Math.round(maxWidthEmu * Math.min(1.0, Math.max(0.1, displayScale || 1.0))));
-                                        const drawings = xmlDoc.getElementsByTagName("w:drawing");
-                                        const placeholders = [];
-                                        for (let i = 0; i < drawings.length; i++) {{
-                                            const drawing = drawings[i];
-                                            const docPr = getChildByTag(drawing, "wp:docPr");
-                                            if (!docPr) continue;
-                                            const descr = docPr.getAttribute("descr") || "";
-                                            if (!descr.startsWith("MERMAID_SRC:")) continue;
-                                            const encoded = descr.substring("MERMAID_SRC:".length);
-                                            const code = decodeURIComponent(encoded);
-                                            const blip = getChildByTag(drawing, "a:blip");
-                                            const ridPng = blip ? blip.getAttribute("r:embed") : null;
-                                            const svgBlip = getChildByTag(drawing, "asvg:svgBlip");
-                                            const ridSvg = svgBlip ? svgBlip.getAttribute("r:embed") : null;
-                                            const container = getChildByTag(drawing, "wp:inline") || getChildByTag(drawing, "wp:anchor");
-                                            const extent = container ? getChildByTag(container, "wp:extent") : null;
-                                            const xfrm = getChildByTag(drawing, "a:xfrm");
-                                            const xfrmExt = xfrm ? getChildByTag(xfrm, "a:ext") : null;
-                                            placeholders.push({{ code, ridPng, ridSvg, extent, xfrmExt, svgBlip }});
-                                        }}
-                                        if (!placeholders.length) {{
-                                            const blob = new Blob([bytes], {{ type: "application/vnd.openxmlformats-officedocument.wordprocessingml.document" }});
-                                            downloadBlob(blob, filename);
-                                            return;
-                                        }}
-                                        // Phase 1: Render all Mermaid diagrams sequentially (mermaid needs DOM)
-                                        const renderResults = [];
-                                        for (let i = 0; i < placeholders.length; i++) {{
-                                            const item = placeholders[i];
-                                            try {{
-                                                const id = "owui-mermaid-" + i;
-                                                const rendered = await window.mermaid.render(id, item.code);
-                                                let svgText = rendered && rendered.svg ? rendered.svg : rendered;
-                                                if (!svgText || typeof svgText !== "string") throw new Error("Mermaid returned empty SVG");
-                                                svgText = normalizeSvgForWord(svgText);
-                                                const hasForeignObject = /<foreignObject\\b/i.test(svgText);
-                                                if (hasForeignObject && item.svgBlip) {{
-                                                    try {{ item.svgBlip.parentNode && item.svgBlip.parentNode.removeChild(item.svgBlip); }} catch (_e) {{}}
-                                                    item.ridSvg = null;
-                                                }}
-                                                const svgDoc = new DOMParser().parseFromString(svgText, "image/svg+xml");
-                                                const svgEl = svgDoc.documentElement;
-                                                const vb = parseViewBox(svgEl && svgEl.getAttribute ? svgEl.getAttribute("viewBox") : null);
-                                                const ratio = vb && vb.width > 0 && vb.height > 0 ? (vb.width / vb.height) : (4/3);
-                                                const widthEmu = maxWidthEmuScaled;
-                                                const heightEmu = Math.max(1, Math.round(widthEmu / ratio));
-                                                renderResults.push({{ item, svgText, widthEmu, heightEmu, success: true }});
-                                            }} catch (err) {{
-                                                console.error("Mermaid render failed for block", i, err);
-                                                renderResults.push({{ item, svgText: null, widthEmu: 0, heightEmu: 0, success: false }});
-                                            }}
-                                        }}
-                                        // Phase 2: Convert SVG to PNG in parallel for performance
-                                        async function svgToPng(svgText, targetWidthPx, targetHeightPx) {{
-                                            const canvas = document.createElement("canvas");
-                                            const ctx = canvas.getContext("2d");
-                                            const scale = Math.max(1.0, pngScale || 1.0);
-                                            canvas.width = Math.round(targetWidthPx * scale);
-                                            canvas.height = Math.round(targetHeightPx * scale);
-                                            ctx.setTransform(1, 0, 0, 1, 0, 0);
-                                            if (bgFill) {{
-                                                ctx.fillStyle = bgFill;
-                                                ctx.fillRect(0, 0, canvas.width, canvas.height);
-                                            }}
-                                            ctx.scale(scale, scale);
-                                            const img = new Image();
-                                            await new Promise((resolve, reject) => {{
-                                                img.onload = resolve;
-                                                img.onerror = reject;
-                                                img.src = "data:image/svg+xml;base64," + btoa(unescape(encodeURIComponent(svgText)));
-                                            }});
-                                            ctx.drawImage(img, 0, 0, targetWidthPx, targetHeightPx);
-                                            const pngDataUrl = canvas.toDataURL("image/png");
-                                            return pngDataUrl.split(",")[1];
-                                        }}
-                                        // Create PNG conversion promises for parallel execution
-                                        const pngPromises = renderResults.map(async (result, i) => {{
-                                            if (!result.success || !result.svgText) return null;
-                                            const {{ item, widthEmu, heightEmu }} = result;
-                                            if (!item.ridPng || !rIdToTarget[item.ridPng]) return null;
-                                            
-                                            const targetWidthPx = Math.max(1, Math.round(widthEmu / 9525));
-                                            const targetHeightPx = Math.max(1, Math.round(heightEmu / 9525));
-                                            
-                                            try {{
-                                                const pngBase64 = await svgToPng(result.svgText, targetWidthPx, targetHeightPx);
-                                                return {{ index: i, pngBase64, path: "word/" + rIdToTarget[item.ridPng] }};
-                                            }} catch (err) {{
-                                                console.error("PNG conversion failed for block", i, err);
-                                                return null;
-                                            }}
-                                        }});
-                                        // Wait for all PNG conversions to complete
-                                        const pngResults = await Promise.all(pngPromises);
-                                        // Phase 3: Update ZIP with all results
-                                        for (let i = 0; i < renderResults.length; i++) {{
-                                            const result = renderResults[i];
-                                            if (!result.success) continue;
-                                            
-                                            const {{ item, svgText, widthEmu, heightEmu }} = result;
-                                            
-                                            // Update extent in XML
-                                            if (item.extent) {{
-                                                item.extent.setAttribute("cx", `${{widthEmu}}`);
-                                                item.extent.setAttribute("cy", `${{heightEmu}}`);
-                                            }}
-                                            if (item.xfrmExt) {{
-                                                item.xfrmExt.setAttribute("cx", `${{widthEmu}}`);
-                                                item.xfrmExt.setAttribute("cy", `${{heightEmu}}`);
-                                            }}
-                                            // Write SVG part
-                                            if (item.ridSvg && rIdToTarget[item.ridSvg]) {{
-                                                zip.file("word/" + rIdToTarget[item.ridSvg], svgText);
-                                            }}
-                                        }}
-                                        // Write PNG files from parallel results
-                                        for (const pngResult of pngResults) {{
-                                            if (pngResult && pngResult.pngBase64) {{
-                                                zip.file(pngResult.path, pngResult.pngBase64, {{ base64: true }});
-                                            }}
-                                        }}
-                                        const newDocXml = new XMLSerializer().serializeToString(xmlDoc);
-                                        zip.file("word/document.xml", newDocXml);
-                                        const finalBlob = await zip.generateAsync({{
-                                            type: "blob",
-                                            compression: "DEFLATE",
-                                            compressionOptions: {{ level: 6 }},
-                                        }});
-                                        downloadBlob(finalBlob, filename);
-                                    }} catch (error) {{
-                                        console.error("Export pipeline failed:", error);
-                                        const bytes = decodeBase64ToUint8Array(base64Data);
-                                        const blob = new Blob([bytes], {{ type: "application/vnd.openxmlformats-officedocument.wordprocessingml.document" }});
-                                        downloadBlob(blob, filename);
-                                    }}
-                                }})();
-                                """
+                                "code": "".join(
+                                    [
+                                        _JS_TEMPLATE_HEAD,
+                                        *base64_chunks,
+                                        js_settings,
+                                        js_tail,
+                                    ]
+                                )
                             },
                         }
                     )
@@ -904,10 +1455,15 @@ class Action:
         return ""
     def extract_title(self, content: str) -> str:
         """Extract title from Markdown h1/h2 only"""
-        lines = content.split("\n")
+        # The title heading sits near the top; don't split a multi-MB reply in full.
+        lines = content.split("\n", _TITLE_SCAN_MAX_LINES)[:_TITLE_SCAN_MAX_LINES]
         for line in lines:
+            stripped = line.strip()
+            # Only heading lines can match; skip the regex for everything else.
+            if not stripped.startswith("#"):
+                continue
             # Match h1-h2 headings only
-            match = re.match(r"^#{1,2}\s+(.+)$", line.strip())
+            match = _TITLE_HEADING_RE.match(stripped)
             if match:
                 return match.group(1).strip()
         return ""
@@ -948,59 +1504,62 @@ class Action:
         """Fetch chat title from database by chat_id"""
         if not chat_id:
             return ""
-        def _load_chat():
-            if user_id:
-                chat = Chats.get_chat_by_id_and_user_id(id=chat_id, user_id=user_id)
-                if chat:
-                    return chat
-            return Chats.get_chat_by_id(chat_id)
+        key = (chat_id, user_id)
+        now = time.monotonic()
+        cached = self._chat_title_cache.get(key)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        # chat_id is the primary key, so the old (id, user_id) lookup followed by an
+        # id-only fallback always resolved the same row; one id query is enough.
+        def _load_title():
+            if get_db is not None and Chat is not None:
+                try:
+                    with get_db() as db:
+                        return db.query(Chat.title).filter_by(id=chat_id).scalar()
+                except Exception as exc:
+                    logger.debug(f"Direct title query failed for chat {chat_id}: {exc}")
+            chat = Chats.get_chat_by_id(chat_id)
+            if not chat:
+                return ""
+            data = getattr(chat, "chat", {}) or {}
+            return data.get("title") or getattr(chat, "title", "")
         try:
-            chat = await asyncio.to_thread(_load_chat)
+            title = await asyncio.to_thread(_load_title)
         except Exception as exc:
             logger.warning(f"Failed to load chat {chat_id}: {exc}")
             return ""
-        if not chat:
-            return ""
-        data = getattr(chat, "chat", {}) or {}
-        title = data.get("title") or getattr(chat, "title", "")
-        return title.strip() if isinstance(title, str) else ""
+        title = title.strip() if isinstance(title, str) else ""
+        if title:
+            cache = self._chat_title_cache
+            if len(cache) >= _CHAT_TITLE_CACHE_MAX:
+                for k in [k for k, (exp, _t) in cache.items() if exp <= now]:
+                    del cache[k]
+                if len(cache) >= _CHAT_TITLE_CACHE_MAX:
+                    # Dicts keep insertion order; drop the oldest entry.
+                    del cache[next(iter(cache))]
+            cache[key] = (now + _CHAT_TITLE_CACHE_TTL, title)
+        return title
     def clean_filename(self, name: str) -> str:
         """Clean illegal characters from filename and strip emoji."""
         if not isinstance(name, str):
             return ""
-        def _is_emoji_codepoint(codepoint: int) -> bool:
-            # Common emoji ranges + flag regional indicators.
-            return (
-                0x1F000 <= codepoint <= 0x1FAFF
-                or 0x1F1E6 <= codepoint <= 0x1F1FF
-                or 0x2600 <= codepoint <= 0x26FF
-                or 0x2700 <= codepoint <= 0x27BF
-                or 0x2300 <= codepoint <= 0x23FF
-                or 0x2B00 <= codepoint <= 0x2BFF
-            )
-        def _is_emoji_modifier(codepoint: int) -> bool:
-            # VS15/VS16, ZWJ, keycap, skin tones, and tag characters used in some emoji sequences.
-            return (
-                codepoint in (0x200D, 0xFE0E, 0xFE0F, 0x20E3)
-                or 0x1F3FB <= codepoint <= 0x1F3FF
-                or 0xE0020 <= codepoint <= 0xE007F
-            )
-        without_emoji = "".join(
-            ch
-            for ch in name
-            if not (_is_emoji_codepoint(ord(ch)) or _is_emoji_modifier(ord(ch)))
-        )
-        cleaned = re.sub(r'[\\/*?:"<>|]', "", without_emoji)
-        cleaned = re.sub(r"\s+", " ", cleaned).strip().strip(".")
+        without_emoji = name.translate(_EMOJI_DELETE_TABLE)
+        cleaned = _FILENAME_ILLEGAL_RE.sub("", without_emoji)
+        cleaned = _WHITESPACE_RE.sub(" ", cleaned).strip().strip(".")
         return cleaned[:50].strip()
     def _max_embed_image_bytes(self) -> int:
         mb = getattr(self.valves, "MAX_EMBED_IMAGE_MB", 20)
+        cached = self._max_embed_image_bytes_cache
+        if cached is not None and cached[0] == mb:
+            return cached[1]
         try:
             mb_i = int(mb)
         except Exception:
             mb_i = 20
         mb_i = max(1, mb_i)
-        return mb_i * 1024 * 1024
+        limit = mb_i * 1024 * 1024
+        self._max_embed_image_bytes_cache = (mb, limit)
+        return limit
     def _extract_owui_api_file_id(self, url: str) -> Optional[str]:
         if not isinstance(url, str) or not url:
             return None
@@ -1010,37 +1569,54 @@ class Action:
         fid = (m.group("id") or "").strip()
         return fid or None
     def _read_file_bytes_limited(self, path: Path, max_bytes: int) -> Optional[bytes]:
+        # ValueError: e.g. a stored path with an embedded NUL byte.
         try:
-            if not path.exists():
-                return None
-            try:
-                size = path.stat().st_size
-                if size > max_bytes:
-                    return None
-            except Exception:
-                pass
-            with path.open("rb") as f:
-                data = f.read(max_bytes + 1)
-            if len(data) > max_bytes:
+            fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        except (OSError, ValueError):
+            return None
+        try:
+            size = os.fstat(fd).st_size
+            if size > max_bytes:
                 return None
-            return data
-        except Exception:
+            # Request only what the file holds (+1 to notice growth) instead of a
+            # max_bytes-sized buffer per image. Reads can come back short (NFS,
+            # FUSE), so keep reading until EOF or past the limit.
+            limit = max_bytes + 1
+            chunks: List[bytes] = []
+            got = 0
+            while got < limit:
+                chunk = os.read(fd, min(limit - got, max(size + 1 - got, 64 * 1024)))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                got += len(chunk)
+        except (OSError, ValueError):
+            return None
+        finally:
+            os.close(fd)
+        if got > max_bytes:
             return None
+        return chunks[0] if len(chunks) == 1 else b"".join(chunks)
     def _decode_base64_limited(self, b64: str, max_bytes: int) -> Optional[bytes]:
         if not isinstance(b64, str):
             return None
-        s = re.sub(r"\s+", "", b64.strip())
+        s = b64.translate(_B64_WHITESPACE_DROP)
         if not s:
             return None
-        # Rough pre-check: base64 expands by ~4/3. Avoid decoding clearly oversized payloads.
-        est = (len(s) * 3) // 4
-        if est > max_bytes:
+        mod = len(s) & 3
+        if mod == 1:
+            # A single trailing sextet cannot encode a byte; not valid base64.
             return None
-        pad = (-len(s)) % 4
-        if pad:
-            s = s + ("=" * pad)
+        # Exact decoded size from the length, before decoding anything.
+        padding = 2 if s.endswith("==") else 1 if s.endswith("=") else 0
+        decoded_len = (len(s) >> 2) * 3 - padding + (mod - 1 if mod else 0)
+        if decoded_len > max_bytes:
+            return None
+        data = s.encode("ascii", "ignore")
+        if mod:
+            data += b"=" * (4 - mod)
         try:
-            out = base64.b64decode(s, validate=False)
+            out = base64.b64decode(data, validate=False)
         except (binascii.Error, ValueError):
             return None
         if len(out) > max_bytes:
@@ -1054,13 +1630,17 @@ class Action:
             return None
         b64 = m.group("b64") or ""
         return self._decode_base64_limited(b64, max_bytes)
-    def _read_from_s3(self, s3_path: str, max_bytes: int) -> Optional[bytes]:
-        """Read file directly from S3 using environment variables for credentials."""
+    def _read_from_s3_sync(self, s3_path: str, max_bytes: int) -> Optional[bytes]:
+        """Read file directly from S3 using environment variables for credentials.
+        Blocking; only call it from a worker thread (see _prefetch_images).
+        """
         if not BOTO3_AVAILABLE:
             return None
         # Parse s3://bucket/key
         if not s3_path.startswith("s3://"):
             return None
+        if s3_path in self._failed_s3_paths:
+            return None
         path_without_prefix = s3_path[5:]  # Remove 's3://'
         parts = path_without_prefix.split("/", 1)
         if len(parts) < 2:
@@ -1078,28 +1658,91 @@ class Action:
             )
             return None
         try:
-            s3_config = BotoConfig(
-                s3={"addressing_style": addressing_style},
-                connect_timeout=5,
-                read_timeout=15,
+            s3_client = self._get_s3_client(
+                endpoint_url, access_key, secret_key, addressing_style
             )
-            s3_client = boto3.client(
-                "s3",
-                endpoint_url=endpoint_url,
-                aws_access_key_id=access_key,
-                aws_secret_access_key=secret_key,
-                config=s3_config,
+            # Ask only for the first max_bytes + 1 bytes so oversized objects are not
+            # transferred in full just to be rejected.
+            response = s3_client.get_object(
+                Bucket=bucket, Key=key, Range=f"bytes=0-{max_bytes}"
             )
-            response = s3_client.get_object(Bucket=bucket, Key=key)
             body = response["Body"]
+            # "bytes 0-N/TOTAL": an oversized object is known before its body is read.
+            total = (response.get("ContentRange") or "").rpartition("/")[2]
+            if total.isdigit() and int(total) > max_bytes:
+                body.close()
+                self._failed_s3_paths.add(s3_path)
+                return None
             data = body.read(max_bytes + 1)
             body.close()
             if len(data) > max_bytes:
+                self._failed_s3_paths.add(s3_path)
                 return None
             return data
         except Exception as e:
             logger.warning(f"S3 direct download failed for {s3_path}: {e}")
+            self._failed_s3_paths.add(s3_path)
             return None
+    def _get_s3_client(
+        self, endpoint_url: str, access_key: str, secret_key: str, addressing_style: str
+    ):
+        # The pid in the key drops clients inherited across a fork.
+        key = (os.getpid(), endpoint_url, access_key, secret_key, addressing_style)
+        client = _S3_CLIENTS.get(key)
+        if client is not None:
+            return client
+        with _S3_CLIENTS_LOCK:
+            client = _S3_CLIENTS.get(key)
+            if client is None:
+                s3_config = BotoConfig(
+                    s3={"addressing_style": addressing_style},
+                    connect_timeout=5,
+                    read_timeout=15,
+                    max_pool_connections=2 * _IMAGE_PREFETCH_CONCURRENCY,
+                )
+                client = boto3.client(
+                    "s3",
+                    endpoint_url=endpoint_url,
+                    aws_access_key_id=access_key,
+                    aws_secret_access_key=secret_key,
+                    config=s3_config,
+                )
+                _S3_CLIENTS[key] = client
+            return client
+    def _http_get_limited(
+        self, url: str, headers: Dict[str, str], max_bytes: int
+    ) -> Optional[bytes]:
+        """GET url and return at most max_bytes + 1 bytes of a 2xx body, else None."""
+        if _HTTP_POOL is not None:
+            resp = _HTTP_POOL.request(
+                "GET", url, headers=headers, preload_content=False
+            )
+            try:
+                if not 200 <= resp.status < 300:
+                    resp.drain_conn()
+                    return None
+                length = resp.headers.get("Content-Length") or ""
+                if length.isdigit() and int(length) > max_bytes:
+                    # Known to be too large: skip the body, don't reuse the socket.
+                    logger.warning(
+                        f"Skipping {url}: Content-Length {length} > {max_bytes} bytes"
+                    )
+                    resp.close()
+                    return None
+                data = resp.read(max_bytes + 1)
+                if len(data) > max_bytes:
+                    # Unread body left on the socket; don't hand it back to the pool.
+                    resp.close()
+                return data
+            finally:
+                resp.release_conn()
+        import urllib.request
+        req = urllib.request.Request(url, headers=headers)
+        # Use a timeout to avoid hanging
+        with urllib.request.urlopen(req, timeout=15) as response:
+            if 200 <= response.status < 300:
+                return response.read(max_bytes + 1)
+        return None
     def _image_bytes_from_owui_file_id(
         self, file_id: str, max_bytes: int
     ) -> Optional[bytes]:
@@ -1132,90 +1775,69 @@ class Action:
         # 2. Try S3 direct download (fastest for object storage)
         s3_path = getattr(file_obj, "path", None)
         if isinstance(s3_path, str) and s3_path.startswith("s3://"):
-            s3_data = self._read_from_s3(s3_path, max_bytes)
+            s3_data = self._read_from_s3_sync(s3_path, max_bytes)
             if s3_data is not None:
                 return s3_data
         # 3. Try file paths (Disk stored)
         # We try multiple path variations to be robust against CWD differences (e.g. Docker vs Local)
+        # path/file_path/absolute_path often hold the same value; try each location once.
+        tried_paths = set()
         for attr in ("path", "file_path", "absolute_path"):
             candidate = getattr(file_obj, attr, None)
             if isinstance(candidate, str) and candidate.strip():
                 # Skip obviously non-local paths (S3, GCS, HTTP)
-                if re.match(r"^(s3://|gs://|https?://)", candidate, re.IGNORECASE):
+                # Case-insensitive scheme test on the 8-char head only.
+                if candidate[:8].lower().startswith(_NON_LOCAL_PATH_PREFIXES):
                     logger.debug(f"Skipping local read for non-local path: {candidate}")
                     continue
                 p = Path(candidate)
                 # Attempt 1: As-is (Absolute or relative to CWD)
-                raw = self._read_file_bytes_limited(p, max_bytes)
-                if raw is not None:
-                    return raw
-                # Attempt 2: Relative to ./data (Common in OpenWebUI)
+                variants = [p]
                 if not p.is_absolute():
-                    try:
-                        raw = self._read_file_bytes_limited(
-                            Path("./data") / p, max_bytes
-                        )
-                        if raw is not None:
-                            return raw
-                    except Exception:
-                        pass
+                    # Attempt 2: Relative to ./data (Common in OpenWebUI)
+                    variants.append(Path("./data") / p)
                     # Attempt 3: Relative to /app/backend/data (Docker default)
-                    try:
-                        raw = self._read_file_bytes_limited(
-                            Path("/app/backend/data") / p, max_bytes
-                        )
-                        if raw is not None:
-                            return raw
-                    except Exception:
-                        pass
+                    variants.append(Path("/app/backend/data") / p)
+                for variant in variants:
+                    if variant in tried_paths:
+                        continue
+                    tried_paths.add(variant)
+                    raw = self._read_file_bytes_limited(variant, max_bytes)
+                    if raw is not None:
+                        return raw
         # 4. Try URL (Object Storage / S3 Public URL)
-        urls_to_try = []
-        url_attr = getattr(file_obj, "url", None)
-        if isinstance(url_attr, str) and url_attr:
-            urls_to_try.append(url_attr)
-        if isinstance(data_field, dict):
-            url_data = data_field.get("url")
-            if isinstance(url_data, str) and url_data:
-                urls_to_try.append(url_data)
-        if urls_to_try:
-            import urllib.request
-            for url in urls_to_try:
-                if not url.startswith(("http://", "https://")):
-                    continue
-                try:
-                    logger.info(
-                        f"Attempting to download file {file_id} from URL: {url}"
-                    )
-                    # Use a timeout to avoid hanging
-                    req = urllib.request.Request(
-                        url, headers={"User-Agent": "OpenWebUI-Export-Plugin"}
+        url_data = data_field.get("url") if isinstance(data_field, dict) else None
+        # file.url and data["url"] are often the same; download each URL once.
+        urls_to_try = dict.fromkeys(
+            u
+            for u in (getattr(file_obj, "url", None), url_data)
+            if isinstance(u, str) and u.startswith(_HTTP_URL_PREFIXES)
+        )
+        for url in urls_to_try:
+            try:
+                logger.info(f"Attempting to download file {file_id} from URL: {url}")
+                data = self._http_get_limited(
+                    url, {"User-Agent": "OpenWebUI-Export-Plugin"}, max_bytes
+                )
+                if data is not None:
+                    if len(data) <= max_bytes:
+                        return data
+                    logger.warning(
+                        f"File {file_id} from URL is too large (> {max_bytes} bytes)"
                     )
-                    with urllib.request.urlopen(req, timeout=15) as response:
-                        if 200 <= response.status < 300:
-                            data = response.read(max_bytes + 1)
-                            if len(data) <= max_bytes:
-                                return data
-                            else:
-                                logger.warning(
-                                    f"File {file_id} from URL is too large (> {max_bytes} bytes)"
-                                )
-                except Exception as e:
-                    logger.warning(f"Failed to download {file_id} from {url}: {e}")
+            except Exception as e:
+                logger.warning(f"Failed to download {file_id} from {url}: {e}")
         # 5. Try fetching via Local API (Last resort for S3/Object Storage without direct URL)
         # If we have the API token and base URL, we can try to fetch the content through the backend API.
         if self._api_base_url:
             api_url = f"{self._api_base_url}/api/v1/files/{file_id}/content"
             try:
-                import urllib.request
                 headers = {"User-Agent": "OpenWebUI-Export-Plugin"}
                 if self._api_token:
                     headers["Authorization"] = self._api_token
-                req = urllib.request.Request(api_url, headers=headers)
-                with urllib.request.urlopen(req, timeout=15) as response:
-                    if 200 <= response.status < 300:
-                        data = response.read(max_bytes + 1)
-                        if len(data) <= max_bytes:
-                            return data
+                data = self._http_get_limited(api_url, headers, max_bytes)
+                if data is not None and len(data) <= max_bytes:
+                    return data
             except Exception:
                 # API fetch failed, just fall through to the next method
                 pass
@@ -1229,6 +1851,65 @@ class Action:
             f"File {file_id} found but no content accessible. Attributes: {dir(file_obj)}"
         )
         return None
+    async def _decode_base64_limited_async(
+        self, b64: str, max_bytes: int
+    ) -> Optional[bytes]:
+        # binascii releases the GIL while decoding large buffers.
+        return await asyncio.to_thread(self._decode_base64_limited, b64, max_bytes)
+    async def _prefetch_images(self, markdown_text: str):
+        """
+        Resolve images referenced by the Markdown up front, off the event loop:
+        - /api/v1/files/<id> lookups (DB, S3, disk, HTTP) run in worker threads,
+          bounded by a semaphore;
+        - large base64 data URLs are decoded in worker threads.
+        Results are consumed by _embed_markdown_image; anything missed there falls
+        back to the synchronous path.
+        """
+        self._prefetched_file_bytes = {}
+        self._prefetched_data_url_bytes = {}
+        if not markdown_text or "![" not in markdown_text:
+            return
+        # Insertion-ordered dicts double as de-duplicating ordered sets.
+        file_ids: Dict[str, None] = {}
+        data_urls: Dict[str, str] = {}
+        for m in _MD_IMAGE_RE.finditer(markdown_text or ""):
+            url = (m.group("url") or "").strip()
+            if url.startswith("<") and url.endswith(">") and len(url) >= 2:
+                url = url[1:-1].strip()
+            if not url:
+                continue
+            if url.lower().startswith("data:"):
+                if len(url) < _DATA_URL_ASYNC_DECODE_MIN_CHARS:
+                    continue
+                dm = _DATA_IMAGE_URL_RE.match(url)
+                if dm and (dm.group("mime") or "").lower() in _DOCX_IMAGE_MIMES:
+                    data_urls.setdefault(url, dm.group("b64") or "")
+                continue
+            file_id = self._extract_owui_api_file_id(url)
+            if file_id:
+                file_ids[file_id] = None
+        if not file_ids and not data_urls:
+            return
+        max_bytes = self._max_embed_image_bytes()
+        semaphore = asyncio.Semaphore(_IMAGE_PREFETCH_CONCURRENCY)
+        async def _fetch(file_id: str) -> Optional[bytes]:
+            async with semaphore:
+                try:
+                    return await asyncio.to_thread(
+                        self._image_bytes_from_owui_file_id, file_id, max_bytes
+                    )
+                except Exception as exc:
+                    logger.warning(f"Prefetch failed for file {file_id}: {exc}")
+                    return None
+        async def _decode(b64: str) -> Optional[bytes]:
+            async with semaphore:
+                return await self._decode_base64_limited_async(b64, max_bytes)
+        file_results, data_results = await asyncio.gather(
+            asyncio.gather(*(_fetch(fid) for fid in file_ids)),
+            asyncio.gather(*(_decode(b64) for b64 in data_urls.values())),
+        )
+        self._prefetched_file_bytes = dict(zip(file_ids, file_results))
+        self._prefetched_data_url_bytes = dict(zip(data_urls, data_results))
     def _add_image_placeholder(self, paragraph, alt: str, reason: str):
         label = (alt or "").strip() or "image"
         msg = f"[{label} not embedded: {reason}]"
@@ -1238,6 +1919,12 @@ class Action:
     ) -> Tuple[bool, Optional[str]]:
         if not image_bytes:
             return False, "empty image bytes"
+        # Reject HTML error pages, SVG, WebP, ... before add_picture builds a run.
+        if not any(
+            image_bytes.startswith(magic, offset)
+            for offset, magic in _DOCX_IMAGE_SIGNATURES
+        ):
+            return False, "unrecognized image format"
         try:
             run = paragraph.add_run()
             width = None
@@ -1246,7 +1933,23 @@ class Action:
                     width = self._available_block_width(self._active_doc)
                 except Exception:
                     width = None
-            run.add_picture(cast(Any, io.BytesIO(image_bytes)), width=width)
+            # Same steps as run.add_picture(), but a repeated image reuses the
+            # rId and EMU size from its first embed: no header re-parse and no
+            # SHA1 scan over the package's image parts.
+            part = run.part
+            key = (hashlib.blake2b(image_bytes, digest_size=16).digest(), width)
+            cached = self._embedded_images.get(key)
+            if cached is not None and cached[0] is part:
+                _part, r_id, filename, cx, cy = cached
+            else:
+                r_id, image = part.get_or_add_image(
+                    cast(Any, io.BytesIO(image_bytes))
+                )
+                cx, cy = image.scaled_dimensions(width, None)
+                filename = image.filename
+                self._embedded_images[key] = (part, r_id, filename, cx, cy)
+            inline = CT_Inline.new_pic_inline(part.next_id, r_id, filename, cx, cy)
+            cast(Any, run)._r.add_drawing(inline)
             return True, None
         except Exception as e:
             return False, str(e)
@@ -1258,7 +1961,18 @@ class Action:
             return
         image_bytes: Optional[bytes] = None
         if u.lower().startswith("data:"):
-            image_bytes = self._image_bytes_from_data_url(u, max_bytes)
+            m = _DATA_IMAGE_URL_RE.match(u)
+            mime = (m.group("mime") or "").lower() if m else ""
+            if mime and mime not in _DOCX_IMAGE_MIMES:
+                # Skip decoding payloads python-docx cannot embed (SVG, WebP, ...).
+                self._add_image_placeholder(
+                    paragraph, alt, f"unsupported image type: {mime}"
+                )
+                return
+            if u in self._prefetched_data_url_bytes:
+                image_bytes = self._prefetched_data_url_bytes[u]
+            else:
+                image_bytes = self._image_bytes_from_data_url(u, max_bytes)
             if image_bytes is None:
                 self._add_image_placeholder(
                     paragraph,
@@ -1272,7 +1986,12 @@ class Action:
                 # External images are not fetched; treat as non-embeddable.
                 self._add_image_placeholder(paragraph, alt, "external URL")
                 return
-            image_bytes = self._image_bytes_from_owui_file_id(file_id, max_bytes)
+            if file_id in self._prefetched_file_bytes:
+                image_bytes = self._prefetched_file_bytes[file_id]
+            else:
+                image_bytes = self._image_bytes_from_owui_file_id(file_id, max_bytes)
+                # Remember misses too, so a repeated reference costs no second lookup.
+                self._prefetched_file_bytes[file_id] = image_bytes
             if image_bytes is None:
                 self._add_image_placeholder(
                     paragraph, alt, f"file unavailable ({file_id})"
@@ -1303,11 +2022,14 @@ class Action:
             self._mermaid_figure_counter = 0
             self._mermaid_placeholder_counter = 0
             self._caption_style_name = None
-            self._citation_anchor_by_index = {}
-            self._citation_refs = self._build_citation_refs(sources or [])
+            self._citation_ref_by_index = self._build_citation_refs(sources or [])
+            self._citation_refs = [
+                self._citation_ref_by_index[idx]
+                for idx in sorted(self._citation_ref_by_index)
+            ]
             self._bookmark_id_counter = 1
-            for ref in self._citation_refs:
-                self._citation_anchor_by_index[ref.idx] = ref.anchor
+            # Fetch/decode images concurrently instead of one by one while rendering.
+            await self._prefetch_images(markdown_text)
             # Set default fonts
             self.set_document_default_font(doc)
             # If there is no h1 in content, prepend chat title as h1 when provided
@@ -1319,6 +2041,7 @@ class Action:
             code_block_content = []
             code_block_info_raw = ""
             code_block_lang = ""
+            code_block_is_mermaid = False
             code_block_attrs: List[str] = []
             in_math_block = False
             math_block_delim = ""
@@ -1326,12 +2049,23 @@ class Action:
             in_list = False
             list_items = []
             list_type = None  # 'ordered' or 'unordered'
+            # Bound once: these run for (nearly) every line of the loop below.
+            math_enabled = self.valves.MATH_ENABLE
+            extract_single_line_math = self._extract_single_line_math
+            add_list_to_doc = self.add_list_to_doc
+            add_paragraph = self.add_paragraph
             total_lines = len(lines)
-            last_update_time = time.time()
-            while i < len(lines):
-                # Update status every 2 seconds
-                if event_emitter and time.time() - last_update_time > 2.0:
-                    progress = int((i / total_lines) * 100)
+            percent_scale = 100.0 / max(total_lines, 1)
+            monotonic = time.monotonic
+            last_update_time = monotonic()
+            while i < total_lines:
+                # Update status every 2 seconds; only read the clock every 1024 lines.
+                if (
+                    event_emitter
+                    and (i & 0x3FF) == 0
+                    and monotonic() - last_update_time > 2.0
+                ):
+                    progress = int(i * percent_scale)
                     await event_emitter(
                         {
                             "type": "status",
@@ -1341,24 +2075,24 @@ class Action:
                             },
                         }
                     )
-                    last_update_time = time.time()
+                    last_update_time = monotonic()
                 line = lines[i]
+                stripped = line.strip()
                 # Handle display math blocks (\[...\] or $$...$$)
-                if not in_code_block and self.valves.MATH_ENABLE:
-                    single_line = self._extract_single_line_math(line)
+                if not in_code_block and math_enabled:
+                    single_line = extract_single_line_math(stripped)
                     if single_line is not None:
                         if in_list and list_items:
-                            self.add_list_to_doc(doc, list_items, list_type)
+                            add_list_to_doc(doc, list_items, list_type)
                             list_items = []
                             in_list = False
                         self._add_display_equation(doc, single_line)
                         i += 1
                         continue
                     if not in_math_block:
-                        stripped = line.strip()
                         if stripped in (r"\[", "$$"):
                             if in_list and list_items:
-                                self.add_list_to_doc(doc, list_items, list_type)
+                                add_list_to_doc(doc, list_items, list_type)
                                 list_items = []
                                 in_list = False
                             in_math_block = True
@@ -1367,7 +2101,6 @@ class Action:
                             i += 1
                             continue
                     else:
-                        stripped = line.strip()
                         close = r"\]" if math_block_delim == r"\[" else "$$"
                         if stripped == close:
                             in_math_block = False
@@ -1381,30 +2114,32 @@ class Action:
                         i += 1
                         continue
                 # Handle code blocks
-                if line.strip().startswith("```"):
+                if stripped.startswith("```"):
                     if not in_code_block:
                         # Process pending list first
                         if in_list and list_items:
-                            self.add_list_to_doc(doc, list_items, list_type)
+                            add_list_to_doc(doc, list_items, list_type)
                             list_items = []
                             in_list = False
                         in_code_block = True
-                        code_block_info_raw = line.strip()[3:].strip()
+                        code_block_info_raw = stripped[3:].strip()
                         code_block_lang, code_block_attrs = self._parse_fence_info(
                             code_block_info_raw
                         )
+                        code_block_is_mermaid = code_block_lang.lower() == "mermaid"
                         code_block_content = []
                     else:
                         # End code block
                         in_code_block = False
                         code_text = "\n".join(code_block_content)
-                        if code_block_lang.lower() == "mermaid":
+                        if code_block_is_mermaid:
                             self._insert_mermaid_placeholder(doc, code_text)
                         else:
                             self.add_code_block(doc, code_text, code_block_lang)
                         code_block_content = []
                         code_block_info_raw = ""
                         code_block_lang = ""
+                        code_block_is_mermaid = False
                         code_block_attrs = []
                     i += 1
                     continue
@@ -1412,25 +2147,37 @@ class Action:
                     code_block_content.append(line)
                     i += 1
                     continue
+                # Plain prose (most lines): no block pattern below can match, so skip
+                # straight to the paragraph case without probing any regex.
+                c0 = stripped[:1]
+                if c0 and c0 not in _BLOCK_START_CHARS and not c0.isdecimal():
+                    if in_list and list_items:
+                        add_list_to_doc(doc, list_items, list_type)
+                        list_items = []
+                        in_list = False
+                    add_paragraph(doc, line)
+                    i += 1
+                    continue
                 # Handle tables
-                if line.strip().startswith("|") and line.strip().endswith("|"):
+                if stripped.startswith("|") and stripped.endswith("|"):
                     # Process pending list first
                     if in_list and list_items:
-                        self.add_list_to_doc(doc, list_items, list_type)
+                        add_list_to_doc(doc, list_items, list_type)
                         list_items = []
                         in_list = False
                     table_lines = []
-                    while i < len(lines) and lines[i].strip().startswith("|"):
+                    # Only the leading side matters for the prefix test.
+                    while i < total_lines and lines[i].lstrip().startswith("|"):
                         table_lines.append(lines[i])
                         i += 1
                     self.add_table(doc, table_lines)
                     continue
                 # Handle headings
-                header_match = re.match(r"^(#{1,6})\s+(.+)$", line.strip())
+                header_match = _HEADING_RE.match(stripped)
                 if header_match:
                     # Process pending list first
                     if in_list and list_items:
-                        self.add_list_to_doc(doc, list_items, list_type)
+                        add_list_to_doc(doc, list_items, list_type)
                         list_items = []
                         in_list = False
                     level = len(header_match.group(1))
@@ -1439,11 +2186,11 @@ class Action:
                     i += 1
                     continue
                 # Handle unordered lists
-                unordered_match = re.match(r"^(\s*)[-*+]\s+(.+)$", line)
+                unordered_match = _UNORDERED_LIST_RE.match(line)
                 if unordered_match:
                     if not in_list or list_type != "unordered":
                         if in_list and list_items:
-                            self.add_list_to_doc(doc, list_items, list_type)
+                            add_list_to_doc(doc, list_items, list_type)
                             list_items = []
                         in_list = True
                         list_type = "unordered"
@@ -1452,11 +2199,11 @@ class Action:
                     i += 1
                     continue
                 # Handle ordered lists
-                ordered_match = re.match(r"^(\s*)\d+[.)]\s+(.+)$", line)
+                ordered_match = _ORDERED_LIST_RE.match(line)
                 if ordered_match:
                     if not in_list or list_type != "ordered":
                         if in_list and list_items:
-                            self.add_list_to_doc(doc, list_items, list_type)
+                            add_list_to_doc(doc, list_items, list_type)
                             list_items = []
                         in_list = True
                         list_type = "ordered"
@@ -1465,46 +2212,51 @@ class Action:
                     i += 1
                     continue
                 # Handle blockquotes
-                if line.strip().startswith(">"):
+                if stripped.startswith(">"):
                     # Process pending list first
                     if in_list and list_items:
-                        self.add_list_to_doc(doc, list_items, list_type)
+                        add_list_to_doc(doc, list_items, list_type)
                         list_items = []
                         in_list = False
                     # Collect consecutive quote lines
                     blockquote_lines = []
-                    while i < len(lines) and lines[i].strip().startswith(">"):
-                        # Remove leading > and optional space
-                        quote_line = re.sub(r"^>\s?", "", lines[i])
+                    while i < total_lines and lines[i].lstrip().startswith(">"):
+                        # Remove leading > and optional space (a line with indentation
+                        # before the > is kept as-is)
+                        quote_line = lines[i]
+                        if quote_line[:1] == ">":
+                            quote_line = quote_line[1:]
+                            if quote_line[:1].isspace():
+                                quote_line = quote_line[1:]
                         blockquote_lines.append(quote_line)
                         i += 1
                     self.add_blockquote(doc, "\n".join(blockquote_lines))
                     continue
                 # Handle horizontal rules
-                if re.match(r"^[-*_]{3,}$", line.strip()):
+                if _HR_RE.match(stripped):
                     # Process pending list first
                     if in_list and list_items:
-                        self.add_list_to_doc(doc, list_items, list_type)
+                        add_list_to_doc(doc, list_items, list_type)
                         list_items = []
                         in_list = False
                     self.add_horizontal_rule(doc)
                     i += 1
                     continue
                 # Handle empty lines
-                if not line.strip():
+                if not stripped:
                     # End list
                     if in_list and list_items:
-                        self.add_list_to_doc(doc, list_items, list_type)
+                        add_list_to_doc(doc, list_items, list_type)
                         list_items = []
                         in_list = False
                     i += 1
                     continue
                 # Handle normal paragraphs
                 if in_list and list_items:
-                    self.add_list_to_doc(doc, list_items, list_type)
+                    add_list_to_doc(doc, list_items, list_type)
                     list_items = []
                     in_list = False
-                self.add_paragraph(doc, line)
+                add_paragraph(doc, line)
                 i += 1
             # Process remaining list
             if in_list and list_items:
@@ -1520,14 +2272,18 @@ class Action:
             return doc
         finally:
             self._active_doc = None
+            self._prefetched_file_bytes = {}
+            self._prefetched_data_url_bytes = {}
+            self._failed_s3_paths = set()
+            self._embedded_images = {}
     def _extract_single_line_math(self, line: str) -> Optional[str]:
         s = line.strip()
         # \[ ... \]
-        m = re.match(r"^\\\[(.*)\\\]$", s)
+        m = _DISPLAY_MATH_BRACKET_RE.match(s)
         if m:
             return m.group(1).strip()
         # $$ ... $$
-        m = re.match(r"^\$\$(.*)\$\$$", s)
+        m = _DISPLAY_MATH_DOLLAR_RE.match(s)
         if m:
             return m.group(1).strip()
         return None
@@ -1537,8 +2293,58 @@ class Action:
         OpenWebUI can include reasoning as interleaved <details type=\"reasoning\">...</details>
         (and sometimes <think>/<analysis> blocks). These should never be exported into DOCX.
         """
-        if not text:
+        if not text or "<" not in text:
+            return text
+        # Literal pre-check (tags match case-insensitively): typical answers have no
+        # reasoning markup, so skip the regex pass and the copy it makes.
+        lowered = text.lower()
+        if all(marker not in lowered for marker in _REASONING_MARKERS):
             return text
+        # One pass over the tags with a stack per element name, so nested blocks
+        # close at their matching tag. Only outermost reasoning spans are removed.
+        open_tags: Dict[str, List[Tuple[int, bool]]] = {}
+        spans: List[Tuple[int, int]] = []
+        for m in _REASONING_TAG_RE.finditer(text):
+            name = m.group("name").lower()
+            stack = open_tags.setdefault(name, [])
+            if not m.group("close"):
+                is_reasoning = name != "details" or bool(
+                    _REASONING_TYPE_ATTR_RE.search(m.group("attrs"))
+                )
+                stack.append((m.start(), is_reasoning))
+            else:
+                if not stack:
+                    # A stray close: the tags do not nest.
+                    return self._strip_reasoning_blocks_first_close(text)
+                start, is_reasoning = stack.pop()
+                if is_reasoning:
+                    spans.append((start, m.end()))
+        if any(r for stack in open_tags.values() for _, r in stack):
+            # A reasoning block left open usually means the reasoning mentions its
+            # own tag ("<think> tags", "a <details> element") and that mention took
+            # the block's close. Matching the first close keeps it out of the export.
+            return self._strip_reasoning_blocks_first_close(text)
+        spans.sort()
+        parts: List[str] = []
+        pos = 0
+        for start, end in spans:
+            if end <= pos:
+                # Nested inside a span that is already removed.
+                continue
+            if start < pos:
+                # Blocks with different tags cross each other.
+                return self._strip_reasoning_blocks_first_close(text)
+            parts.append(text[pos:start])
+            pos = end
+        parts.append(text[pos:])
+        cur = "".join(parts)
+        # Clean up excessive blank lines left by removals.
+        cur = _EXCESS_BLANK_LINES_RE.sub("\n\n\n", cur)
+        return cur
+    def _strip_reasoning_blocks_first_close(self, text: str) -> str:
+        # Fallback for tags that do not nest: end each reasoning block at its first
+        # matching close tag, so mentions of the tags inside reasoning never keep the
+        # block (and its text) in the export.
         cur = text
         for _ in range(10):
             prev = cur
@@ -1547,9 +2353,7 @@ class Action:
             cur = _ANALYSIS_RE.sub("", cur)
             if cur == prev:
                 break
-        # Clean up excessive blank lines left by removals.
-        cur = re.sub(r"\n{4,}", "\n\n\n", cur)
-        return cur
+        return _EXCESS_BLANK_LINES_RE.sub("\n\n\n", cur)
     def _add_display_equation(self, doc: Document, latex: str):
         latex = (latex or "").strip()
         if not latex:
@@ -1558,8 +2362,7 @@ class Action:
             self.add_code_block(doc, latex, "latex")
             return
         try:
-            mathml = latex_to_mathml(latex)
-            omml = mathml2omml.convert(mathml)
+            omml = _latex_to_omml(latex)
             para = doc.add_paragraph()
             para.alignment = WD_ALIGN_PARAGRAPH.CENTER
             cast(Any, para)._p.append(self._wrap_omml_for_word(omml))
@@ -1567,13 +2370,12 @@ class Action:
             logger.warning(f"Math conversion failed; falling back to text: {exc}")
             self.add_code_block(doc, latex, "latex")
     def _wrap_omml_for_word(self, omml: str):
-        m_ns = "http://schemas.openxmlformats.org/officeDocument/2006/math"
-        w_ns = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
         # Keep the OMML payload as-is, but ensure it has the math namespace declared.
-        xml = f'<m:oMathPara xmlns:m="{m_ns}" xmlns:w="{w_ns}">{omml}</m:oMathPara>'
-        return parse_xml(xml)
+        # Copying a cached tree is cheaper than re-parsing a repeated equation.
+        return copy.deepcopy(_parse_omath_para(omml))
     # (Math warning paragraphs removed)
-    def _build_citation_refs(self, sources: List[dict]) -> List[_CitationRef]:
+    def _build_citation_refs(self, sources: List[dict]) -> Dict[int, _CitationRef]:
+        # source id -> citation number; every new id gets its ref right away.
         citation_idx_map: Dict[str, int] = {}
         refs_by_idx: Dict[int, _CitationRef] = {}
         for source in sources or []:
@@ -1582,56 +2384,64 @@ class Action:
             documents = source.get("document") or []
             metadatas = source.get("metadata") or []
             src_info = source.get("source") or {}
-            src_name = src_info.get("name") if isinstance(src_info, dict) else None
-            src_id_default = src_info.get("id") if isinstance(src_info, dict) else None
-            src_urls = src_info.get("urls") if isinstance(src_info, dict) else None
+            if not isinstance(src_info, dict):
+                src_info = {}
+            src_name = src_info.get("name")
+            if not (isinstance(src_name, str) and src_name.strip()):
+                src_name = None
+            src_id_default = src_info.get("id")
+            src_urls = src_info.get("urls")
+            src_url = (
+                src_urls[0]
+                if isinstance(src_urls, list)
+                and src_urls
+                and isinstance(src_urls[0], str)
+                and src_urls[0].startswith(_HTTP_URL_PREFIXES)
+                else None
+            )
             if not isinstance(documents, list):
-                documents = []
+                continue
             if not isinstance(metadatas, list):
                 metadatas = []
-            for idx_doc, _doc_text in enumerate(documents):
-                meta = metadatas[idx_doc] if idx_doc < len(metadatas) else {}
+            n_meta = len(metadatas)
+            for idx_doc in range(len(documents)):
+                meta = metadatas[idx_doc] if idx_doc < n_meta else None
                 if not isinstance(meta, dict):
                     meta = {}
                 source_id = meta.get("source") or src_id_default or "N/A"
                 source_id_str = str(source_id)
-                if source_id_str not in citation_idx_map:
-                    citation_idx_map[source_id_str] = len(citation_idx_map) + 1
-                idx = citation_idx_map[source_id_str]
-                if idx in refs_by_idx:
+                if source_id_str in citation_idx_map:
                     continue
-                url: Optional[str] = None
-                if isinstance(source_id, str) and re.match(r"^https?://", source_id):
-                    url = source_id
-                elif isinstance(meta.get("url"), str) and re.match(
-                    r"^https?://", meta["url"]
+                idx = len(citation_idx_map) + 1
+                citation_idx_map[source_id_str] = idx
+                meta_url = meta.get("url")
+                if isinstance(source_id, str) and source_id.startswith(
+                    _HTTP_URL_PREFIXES
                 ):
-                    url = meta["url"]
-                elif isinstance(src_urls, list) and src_urls:
-                    if isinstance(src_urls[0], str) and re.match(
-                        r"^https?://", src_urls[0]
-                    ):
-                        url = src_urls[0]
+                    url: Optional[str] = source_id
+                elif isinstance(meta_url, str) and meta_url.startswith(
+                    _HTTP_URL_PREFIXES
+                ):
+                    url = meta_url
+                else:
+                    url = src_url
+                meta_title = meta.get("title")
+                meta_name = meta.get("name")
                 title = (
-                    (meta.get("title") if isinstance(meta.get("title"), str) else None)
-                    or (meta.get("name") if isinstance(meta.get("name"), str) else None)
-                    or (
-                        src_name
-                        if isinstance(src_name, str) and src_name.strip()
-                        else None
-                    )
-                    or (url if url else None)
+                    (meta_title if isinstance(meta_title, str) else None)
+                    or (meta_name if isinstance(meta_name, str) else None)
+                    or src_name
+                    or url
                     or source_id_str
                 )
-                anchor = f"OWUIRef{idx}"
                 refs_by_idx[idx] = _CitationRef(
                     idx=idx,
-                    anchor=anchor,
+                    anchor=f"OWUIRef{idx}",
                     title=title,
                     url=url,
                     source_id=source_id_str,
                 )
-        return [refs_by_idx[i] for i in sorted(refs_by_idx.keys())]
+        return refs_by_idx
     def _add_bookmark(self, paragraph, name: str):
         bookmark_id = self._bookmark_id_counter
         self._bookmark_id_counter += 1
@@ -1644,18 +2454,9 @@ class Action:
         p.insert(0, start)
         p.append(end)
     def _add_internal_hyperlink(self, paragraph, display_text: str, anchor: str):
-        hyperlink = OxmlElement("w:hyperlink")
+        hyperlink = copy.deepcopy(_INTERNAL_HYPERLINK_TEMPLATE)
         hyperlink.set(qn("w:anchor"), anchor)
-        new_run = OxmlElement("w:r")
-        rPr = OxmlElement("w:rPr")
-        rStyle = OxmlElement("w:rStyle")
-        rStyle.set(qn("w:val"), "Hyperlink")
-        rPr.append(rStyle)
-        new_run.append(rPr)
-        t = OxmlElement("w:t")
-        t.text = display_text
-        new_run.append(t)
-        hyperlink.append(new_run)
+        hyperlink[0][-1].text = display_text
         cast(Any, paragraph)._p.append(hyperlink)
     def _add_references_section(self, doc: Document):
         self.add_heading(doc, self._get_msg("references"), 2)
@@ -1670,7 +2471,10 @@ class Action:
                     para, ref.title, bold=False, italic=False, strike=False
                 )
     def _parse_fence_info(self, info_raw: str) -> Tuple[str, List[str]]:
-        parts = [p for p in (info_raw or "").split() if p.strip()]
+        if not info_raw:
+            return "", []
+        # str.split() without arguments never yields empty or blank parts.
+        parts = info_raw.split()
         if not parts:
             return "", []
         return parts[0], parts[1:]
@@ -1684,50 +2488,10 @@ class Action:
         """
         text = self._strip_mermaid_title_for_render(source)
         return text
-    def _png_with_text_chunk(self, png_bytes: bytes, keyword: str, value: str) -> bytes:
-        """
-        Ensure placeholder PNGs stay distinct in the DOCX package:
-        python-docx may deduplicate identical image bytes into one media part.
-        We insert a small tEXt chunk so each placeholder is unique, without changing
-        dimensions or requiring external imaging libraries.
-        """
-        if not png_bytes.startswith(b"\x89PNG\r\n\x1a\n"):
-            return png_bytes
-        keyword_b = (keyword or "owui").encode("latin-1", errors="ignore")[:79]
-        keyword_b = keyword_b.replace(b"\x00", b"") or b"owui"
-        value_b = (value or "").encode("latin-1", errors="ignore")
-        data = keyword_b + b"\x00" + value_b
-        chunk_type = b"tEXt"
-        crc = zlib.crc32(chunk_type + data) & 0xFFFFFFFF
-        chunk = (
-            struct.pack("!I", len(data)) + chunk_type + data + struct.pack("!I", crc)
-        )
-        out = bytearray()
-        out.extend(png_bytes[:8])
-        offset = 8
-        inserted = False
-        while offset + 8 <= len(png_bytes):
-            length = struct.unpack("!I", png_bytes[offset : offset + 4])[0]
-            ctype = png_bytes[offset + 4 : offset + 8]
-            chunk_total = 12 + length
-            if offset + chunk_total > len(png_bytes):
-                break
-            if ctype == b"IEND" and not inserted:
-                out.extend(chunk)
-                inserted = True
-            out.extend(png_bytes[offset : offset + chunk_total])
-            offset += chunk_total
-            if ctype == b"IEND":
-                break
-        if not inserted:
-            return png_bytes
-        return bytes(out)
     def _make_mermaid_placeholder_png(self, seed: str) -> bytes:
-        return self._png_with_text_chunk(_TRANSPARENT_1PX_PNG, "owui", seed)
+        return _mermaid_placeholder_png(seed)
     def _dummy_mermaid_svg_bytes(self) -> bytes:
-        return (
-            '<svg xmlns="http://www.w3.org/2000/svg" width="1" height="1" viewBox="0 0 1 1"></svg>'
-        ).encode("utf-8")
+        return _DUMMY_MERMAID_SVG
     def _insert_mermaid_placeholder(self, doc: Document, mermaid_source: str):
         caption_title: Optional[str] = (
             self._extract_mermaid_title(mermaid_source)
@@ -1736,21 +2500,20 @@ class Action:
         )
         source_for_render = mermaid_source
         if self.valves.MERMAID_OPTIMIZE_LAYOUT:
-            source_for_render = re.sub(
-                r"^(graph|flowchart)\s+LR\b",
-                r"\1 TD",
-                source_for_render,
-                flags=re.MULTILINE | re.IGNORECASE,
-            )
+            source_for_render = _MERMAID_LR_RE.sub(r"\1 TD", source_for_render)
         source_for_render = self._prepare_mermaid_for_js(source_for_render)
         self._mermaid_placeholder_counter += 1
-        seed = hashlib.sha256(
+        # Only a uniqueness tag (16 hex chars); no cryptographic strength needed.
+        seed = hashlib.blake2b(
             f"{self._mermaid_placeholder_counter}\n{source_for_render}".encode(
                 "utf-8", errors="replace"
-            )
-        ).hexdigest()[:16]
+            ),
+            digest_size=8,
+        ).hexdigest()
         png_bytes = self._make_mermaid_placeholder_png(seed)
         try:
+            # BytesIO over bytes shares the buffer until written to, so a fresh
+            # wrapper per placeholder costs no copy (unlike a reused, rewritten one).
             shape = doc.add_picture(cast(Any, io.BytesIO(png_bytes)))
         except Exception as e:
             logger.warning(f"Failed to add Mermaid placeholder image: {e}")
@@ -1772,6 +2535,8 @@ class Action:
             logger.warning(f"Failed to annotate Mermaid placeholder: {exc}")
         self._add_mermaid_caption(doc, caption_title)
     def _extract_mermaid_title(self, source: str) -> Optional[str]:
+        if not _MERMAID_TITLE_WORD_RE.search(source or ""):
+            return None
         lines = self._normalize_mermaid_text(source).split("\n")
         header_found = False
         for raw in lines:
@@ -1788,71 +2553,70 @@ class Action:
                 # Mermaid beta/diagram headers can embed a title on the header line, e.g.:
                 # - radar-beta title Foo
                 # - xychart-beta title: "Foo"
-                mt = re.match(
-                    r"^(?P<header>\S.*?)(?:\s+title\s*:?\s+)(?P<title>.+)$",
-                    line,
-                    re.IGNORECASE,
-                )
+                mt = _MERMAID_HEADER_TITLE_RE.match(line)
                 if mt:
                     title = (mt.group("title") or "").strip().strip('"').strip("'")
                     if title:
                         return title
                 continue
-            # title "Foo" / title Foo
-            m = re.match(r'^title\s*:?\s+"(.+)"\s*$', line, re.IGNORECASE)
-            if m:
-                return m.group(1).strip()
-            m = re.match(r"^title\s*:?\s+(.+)$", line, re.IGNORECASE)
+            # title "Foo" / title Foo; most lines are diagram body, skip the regex.
+            if line[:5].lower() != "title":
+                continue
+            m = _MERMAID_TITLE_RE.match(line)
             if m:
-                return m.group(1).strip().strip('"').strip("'")
+                quoted = m.group("quoted")
+                if quoted is not None:
+                    return quoted.strip()
+                return m.group("plain").strip().strip('"').strip("'")
         return None
     def _strip_mermaid_title_for_render(self, source: str) -> str:
         """
         Removes Mermaid title directives from the source before rendering.
         Captions already carry the title.
         """
-        lines = self._normalize_mermaid_text(source).split("\n")
+        text = self._normalize_mermaid_text(source)
+        if not _MERMAID_TITLE_WORD_RE.search(text):
+            return text
         out: List[str] = []
         header_found = False
-        title_stripped = False
-        meaningful_after_header = False
-        for raw in lines:
-            line = raw.rstrip("\n")
+        pos = 0
+        end = len(text)
+        # Only the header and the first meaningful line after it can carry the
+        # title; once both are settled the rest is copied as one slice.
+        while pos < end:
+            nl = text.find("\n", pos)
+            if nl == -1:
+                nl = end
+            line = text[pos:nl]
             stripped = line.strip()
-            if not stripped:
-                out.append(line)
-                continue
-            if stripped.startswith("%%{") and stripped.endswith("}%%"):
-                out.append(line)
-                continue
-            if stripped.startswith("%%"):
+            if (
+                not stripped
+                or (stripped.startswith("%%{") and stripped.endswith("}%%"))
+                or stripped.startswith("%%")
+            ):
                 out.append(line)
+                pos = nl + 1
                 continue
             if not header_found:
                 header_found = True
                 # Some Mermaid diagram headers can embed a title on the header line, e.g.:
                 # - radar-beta title Foo
                 # - xychart-beta title: "Foo"
-                mt = re.match(
-                    r"^(?P<header>\S.*?)(?:\s+title\s*:?\s+)(?P<title>.+)$",
-                    stripped,
-                    re.IGNORECASE,
-                )
+                mt = _MERMAID_HEADER_TITLE_RE.match(stripped)
                 if mt:
                     cleaned = (mt.group("header") or "").strip()
                     out.append(cleaned if cleaned else stripped)
-                    title_stripped = True
-                    continue
+                    pos = nl + 1
+                    break
                 out.append(line)
+                pos = nl + 1
                 continue
-            if not title_stripped and not meaningful_after_header:
-                # Strip a standalone title directive line early in the diagram.
-                if re.match(r'^title\s*:?\s+(".+"|.+)$', stripped, re.IGNORECASE):
-                    title_stripped = True
-                    continue
-            # Consider this a meaningful content line after header.
-            meaningful_after_header = True
-            out.append(line)
+            # Strip a standalone title directive line early in the diagram.
+            if _MERMAID_TITLE_DIRECTIVE_RE.match(stripped):
+                pos = nl + 1
+            break
+        if pos < end:
+            out.append(text[pos:])
         return "\n".join(out).strip() + "\n"
     def _ensure_caption_style(self, doc: Document) -> str:
         if self._caption_style_name is not None:
@@ -1990,25 +2754,24 @@ class Action:
     def _add_inline_code(self, paragraph, s: str):
         if s == "":
             return
+        code_rpr = _code_run_rpr(self.valves.FONT_CODE)
         def _add_code_run(chunk: str):
             if not chunk:
                 return
             run = paragraph.add_run(chunk)
-            run.font.name = self.valves.FONT_CODE
-            run._element.rPr.rFonts.set(qn("w:eastAsia"), self.valves.FONT_CODE)
-            run.font.size = Pt(10)
-            shading = OxmlElement("w:shd")
-            shading.set(qn("w:fill"), "E8E8E8")
-            run._element.rPr.append(shading)
+            # A fresh text-only run has no rPr; it must be the first child.
+            cast(Any, run)._r.insert(0, copy.deepcopy(code_rpr))
+        if "http" not in s and "www." not in s:
+            # No auto-link candidates; skip the URL scan.
+            _add_code_run(s)
+            return
         i = 0
         for m in _AUTO_URL_RE.finditer(s):
             start, end = m.span()
             if start > i:
                 _add_code_run(s[i:start])
             raw = m.group(0)
-            trimmed = raw
-            while trimmed and trimmed[-1] in ".,;:!?)]}":
-                trimmed = trimmed[:-1]
+            trimmed = raw.rstrip(_URL_TRAILING_PUNCT)
             suffix = raw[len(trimmed) :]
             normalized = self._normalize_url(trimmed)
             if normalized:
@@ -2032,78 +2795,81 @@ class Action:
             self._add_inline_code(paragraph, display_text)
             return
         r_id = part.relate_to(u, RT.HYPERLINK, is_external=True)
-        hyperlink = OxmlElement("w:hyperlink")
+        hyperlink = copy.deepcopy(_code_hyperlink_template(self.valves.FONT_CODE))
         hyperlink.set(qn("r:id"), r_id)
-        new_run = OxmlElement("w:r")
-        rPr = OxmlElement("w:rPr")
-        rFonts = OxmlElement("w:rFonts")
-        rFonts.set(qn("w:ascii"), self.valves.FONT_CODE)
-        rFonts.set(qn("w:hAnsi"), self.valves.FONT_CODE)
-        rFonts.set(qn("w:eastAsia"), self.valves.FONT_CODE)
-        rPr.append(rFonts)
-        sz = OxmlElement("w:sz")
-        sz.set(qn("w:val"), "20")  # 10pt
-        rPr.append(sz)
-        sz_cs = OxmlElement("w:szCs")
-        sz_cs.set(qn("w:val"), "20")
-        rPr.append(sz_cs)
-        shading = OxmlElement("w:shd")
-        shading.set(qn("w:fill"), "E8E8E8")
-        rPr.append(shading)
-        new_run.append(rPr)
-        t = OxmlElement("w:t")
-        t.text = display_text
-        new_run.append(t)
-        hyperlink.append(new_run)
+        hyperlink[0][-1].text = display_text
         cast(Any, paragraph)._p.append(hyperlink)
     def _add_inline_segments(
-        self, paragraph, text: str, bold: bool, italic: bool, strike: bool
+        self,
+        paragraph,
+        text: str,
+        bold: bool,
+        italic: bool,
+        strike: bool,
+        start: int = 0,
+        end: Optional[int] = None,
+        pending: Optional[List[str]] = None,
     ):
-        i = 0
-        n = len(text)
-        def next_special(start: int) -> int:
-            candidates = []
-            for ch in ("`", "!", "[", "*", "_", "~", "$", "\\"):
-                idx = text.find(ch, start)
-                if idx != -1:
-                    candidates.append(idx)
-            idx = text.find(r"\(", start)
-            if idx != -1:
-                candidates.append(idx)
-            idx = text.find("http://", start)
-            if idx != -1:
-                candidates.append(idx)
-            idx = text.find("https://", start)
-            if idx != -1:
-                candidates.append(idx)
-            idx = text.find("www.", start)
-            if idx != -1:
-                candidates.append(idx)
-            return min(candidates) if candidates else n
+        # Only text[start:end] is parsed; nested emphasis recurses with new bounds
+        # on the same string instead of slicing out each nested span.
+        n = len(text) if end is None else end
+        special_search = _INLINE_SPECIAL_RE.search
+        first = special_search(text, start, n)
+        if first is None:
+            # Plain text: one run, no per-construct dispatch.
+            if pending is not None:
+                pending.append(text[start:n])
+            else:
+                self._add_text_run(paragraph, text[start:n], bold, italic, strike)
+            return
+        i = first.start()
+        # Literal text is buffered and written as one run, so escapes and
+        # unmatched markers do not each start a new run. A nested span with the
+        # same formatting shares the caller's buffer, which the caller flushes.
+        owns_pending = pending is None
+        buf: List[str] = [] if pending is None else pending
+        if i > start:
+            buf.append(text[start:i])
+        def flush() -> None:
+            if buf:
+                self._add_text_run(paragraph, "".join(buf), bold, italic, strike)
+                buf.clear()
+        def descend(b: bool, it: bool, st: bool, s0: int, e0: int) -> None:
+            if (b, it, st) == (bold, italic, strike):
+                shared: Optional[List[str]] = buf
+            else:
+                flush()
+                shared = None
+            self._add_inline_segments(
+                paragraph, text, b, it, st, start=s0, end=e0, pending=shared
+            )
         while i < n:
             # Markdown image: ![alt](url)
-            if text.startswith("![", i):
-                close = text.find("]", i + 2)
+            if text.startswith("![", i, n):
+                close = text.find("]", i + 2, n)
                 if close != -1 and close + 1 < n and text[close + 1] == "(":
-                    close_paren = text.find(")", close + 2)
+                    close_paren = text.find(")", close + 2, n)
                     if close_paren != -1:
                         alt = text[i + 2 : close]
                         url = text[close + 2 : close_paren].strip()
                         # Allow angle-bracket wrapped URLs: ![](</api/...>)
                         if url.startswith("<") and url.endswith(">") and len(url) >= 2:
                             url = url[1:-1].strip()
+                        flush()
                         self._embed_markdown_image(paragraph, alt=alt, url=url)
                         i = close_paren + 1
                         continue
             if text[i] == "`":
-                j = text.find("`", i + 1)
+                j = text.find("`", i + 1, n)
                 if j != -1:
+                    flush()
                     self._add_inline_code(paragraph, text[i + 1 : j])
                     i = j + 1
                     continue
             if text.startswith(r"\(", i):
-                j = text.find(r"\)", i + 2)
+                j = text.find(r"\)", i + 2, n)
                 if j != -1:
+                    flush()
                     self._add_inline_equation(
                         paragraph,
                         text[i + 2 : j],
@@ -2119,11 +2885,11 @@ class Action:
                     ch = text[i + 1]
                     # Standard Markdown escapes + $ for math
                     if ch in "\\`*_{}[]()#+-.!|$":
-                        self._add_text_run(paragraph, ch, bold, italic, strike)
+                        buf.append(ch)
                         i += 2
                         continue
                 # Keep other backslashes literal
-                self._add_text_run(paragraph, "\\", bold, italic, strike)
+                buf.append("\\")
                 i += 1
                 continue
             # Handle long run of underscores (fill-in-the-blank)
@@ -2132,9 +2898,7 @@ class Action:
                 while i + run_len < n and text[i + run_len] == "_":
                     run_len += 1
                 if run_len >= 4:
-                    self._add_text_run(
-                        paragraph, text[i : i + run_len], bold, italic, strike
-                    )
+                    buf.append(text[i : i + run_len])
                     i += run_len
                     continue
             # Handle long run of asterisks (separator/mask)
@@ -2143,9 +2907,7 @@ class Action:
                 while i + run_len < n and text[i + run_len] == "*":
                     run_len += 1
                 if run_len >= 4:
-                    self._add_text_run(
-                        paragraph, text[i : i + run_len], bold, italic, strike
-                    )
+                    buf.append(text[i : i + run_len])
                     i += run_len
                     continue
             # Handle long run of tildes (separator)
@@ -2154,9 +2916,7 @@ class Action:
                 while i + run_len < n and text[i + run_len] == "~":
                     run_len += 1
                 if run_len >= 4:
-                    self._add_text_run(
-                        paragraph, text[i : i + run_len], bold, italic, strike
-                    )
+                    buf.append(text[i : i + run_len])
                     i += run_len
                     continue
             # Inline $...$ math (conservative parsing)
@@ -2166,24 +2926,24 @@ class Action:
                 and self.valves.MATH_INLINE_DOLLAR_ENABLE
             ):
                 # Avoid treating $$ as inline math here (block math uses $$ on its own line).
-                if text.startswith("$$", i):
-                    self._add_text_run(paragraph, "$", bold, italic, strike)
+                if text.startswith("$$", i, n):
+                    buf.append("$")
                     i += 1
                     continue
                 # Markdown-ish heuristics to reduce false positives:
                 # - Do not allow whitespace right after opening or right before closing
                 # - Avoid cases like "USD$5" where opening is attached to an alnum
                 if i + 1 >= n or text[i + 1].isspace():
-                    self._add_text_run(paragraph, "$", bold, italic, strike)
+                    buf.append("$")
                     i += 1
                     continue
-                if i > 0 and text[i - 1].isalnum():
-                    self._add_text_run(paragraph, "$", bold, italic, strike)
+                if i > start and text[i - 1].isalnum():
+                    buf.append("$")
                     i += 1
                     continue
                 j = i + 1
                 while True:
-                    j = text.find("$", j)
+                    j = text.find("$", j, n)
                     if j == -1:
                         break
                     # Skip escaped dollars inside: "\$"
@@ -2201,91 +2961,63 @@ class Action:
                     ):
                         # Treat "$5" as currency more often than math.
                         if _CURRENCY_NUMBER_RE.match(inner) and (
-                            i == 0 or text[i - 1].isspace()
+                            i == start or text[i - 1].isspace()
                         ):
-                            self._add_text_run(paragraph, "$", bold, italic, strike)
+                            buf.append("$")
                             i += 1
                             continue
                         # Disallow digit immediately following the closing $ (common in prices like "$5.00" already handled above).
                         if j + 1 < n and text[j + 1].isdigit():
-                            self._add_text_run(paragraph, "$", bold, italic, strike)
+                            buf.append("$")
                             i += 1
                             continue
+                        flush()
                         self._add_inline_equation(
                             paragraph, inner, bold=bold, italic=italic, strike=strike
                         )
                         i = j + 1
                         continue
-                self._add_text_run(paragraph, "$", bold, italic, strike)
+                buf.append("$")
                 i += 1
                 continue
-            if text.startswith("~~", i):
-                j = text.find("~~", i + 2)
+            if text.startswith("~~", i, n):
+                j = text.find("~~", i + 2, n)
                 if j != -1:
-                    self._add_inline_segments(
-                        paragraph,
-                        text[i + 2 : j],
-                        bold=bold,
-                        italic=italic,
-                        strike=True,
-                    )
+                    descend(bold, italic, True, i + 2, j)
                     i = j + 2
                     continue
-            if text.startswith("**", i):
-                j = text.find("**", i + 2)
+            if text.startswith("**", i, n):
+                j = text.find("**", i + 2, n)
                 if j != -1:
-                    self._add_inline_segments(
-                        paragraph,
-                        text[i + 2 : j],
-                        bold=True,
-                        italic=italic,
-                        strike=strike,
-                    )
+                    descend(True, italic, strike, i + 2, j)
                     i = j + 2
                     continue
-            if text.startswith("__", i):
-                j = text.find("__", i + 2)
+            if text.startswith("__", i, n):
+                j = text.find("__", i + 2, n)
                 if j != -1:
-                    self._add_inline_segments(
-                        paragraph,
-                        text[i + 2 : j],
-                        bold=True,
-                        italic=italic,
-                        strike=strike,
-                    )
+                    descend(True, italic, strike, i + 2, j)
                     i = j + 2
                     continue
             if text[i] == "*" and (i + 1 >= n or text[i + 1] != "*"):
-                j = text.find("*", i + 1)
+                j = text.find("*", i + 1, n)
                 if j != -1:
-                    self._add_inline_segments(
-                        paragraph,
-                        text[i + 1 : j],
-                        bold=bold,
-                        italic=True,
-                        strike=strike,
-                    )
+                    descend(bold, True, strike, i + 1, j)
                     i = j + 1
                     continue
             if text[i] == "_" and (i + 1 >= n or text[i + 1] != "_"):
-                j = text.find("_", i + 1)
+                j = text.find("_", i + 1, n)
                 if j != -1:
-                    self._add_inline_segments(
-                        paragraph,
-                        text[i + 1 : j],
-                        bold=bold,
-                        italic=True,
-                        strike=strike,
-                    )
+                    descend(bold, True, strike, i + 1, j)
                     i = j + 1
                     continue
             if text[i] == "[":
-                close = text.find("]", i + 1)
+                close = text.find("]", i + 1, n)
                 if close != -1 and close + 1 < n and text[close + 1] == "(":
-                    close_paren = text.find(")", close + 2)
+                    close_paren = text.find(")", close + 2, n)
                     if close_paren != -1:
                         label = text[i + 1 : close]
                         url = text[close + 2 : close_paren]
+                        flush()
                         self._add_hyperlink(paragraph, label, url)
                         i = close_paren + 1
                         continue
@@ -2294,47 +3026,48 @@ class Action:
                     inner = text[i + 1 : close].strip()
                     if inner.isdigit():
                         idx = int(inner)
-                        anchor = self._citation_anchor_by_index.get(idx)
-                        if anchor:
-                            self._add_internal_hyperlink(paragraph, f"[{idx}]", anchor)
+                        ref = self._citation_ref_by_index.get(idx)
+                        if ref:
+                            flush()
+                            self._add_internal_hyperlink(
+                                paragraph, f"[{idx}]", ref.anchor
+                            )
                             i = close + 1
                             continue
-            m = _AUTO_URL_RE.match(text, i)
+            m = _AUTO_URL_RE.match(text, i, n)
             if m:
                 raw = m.group(0)
-                trimmed = raw
-                while trimmed and trimmed[-1] in ".,;:!?)]}":
-                    trimmed = trimmed[:-1]
+                trimmed = raw.rstrip(_URL_TRAILING_PUNCT)
                 suffix = raw[len(trimmed) :]
                 normalized = self._normalize_url(trimmed)
                 if normalized:
                     # Display the original (trimmed) text; use normalized URL as the target.
+                    flush()
                     self._add_hyperlink(
                         paragraph, trimmed, normalized, display_text=trimmed
                     )
                 else:
-                    self._add_text_run(paragraph, raw, bold, italic, strike)
+                    buf.append(raw)
                     i += len(raw)
                     continue
                 if suffix:
-                    self._add_text_run(paragraph, suffix, bold, italic, strike)
+                    buf.append(suffix)
                 i += len(raw)
                 continue
-            j = next_special(i)
-            if j == i:
-                # Unmatched special character; treat literally to avoid infinite loops.
-                self._add_text_run(paragraph, text[i], bold, italic, strike)
-                i += 1
-            else:
-                self._add_text_run(paragraph, text[i:j], bold, italic, strike)
-                i = j
+            # Literal text up to the next possible construct. Searching from i + 1
+            # also takes an unmatched special character at i as literal text.
+            m = special_search(text, i + 1, n)
+            j = m.start() if m else n
+            buf.append(text[i:j])
+            i = j
+        if owns_pending:
+            flush()
     def _normalize_url(self, url: str) -> str:
         u = (url or "").strip()
         if u.lower().startswith("www."):
             u = "https://" + u
         # Trim common trailing punctuation that often follows URLs in prose.
-        while u and u[-1] in ".,;:!?)]}":
-            u = u[:-1]
+        u = u.rstrip(_URL_TRAILING_PUNCT)
         return u
     def _add_hyperlink(
         self, paragraph, text: str, url: str, display_text: Optional[str] = None
@@ -2351,24 +3084,9 @@ class Action:
             run.font.underline = True
             return
         r_id = part.relate_to(u, RT.HYPERLINK, is_external=True)
-        hyperlink = OxmlElement("w:hyperlink")
+        hyperlink = copy.deepcopy(_HYPERLINK_TEMPLATE)
         hyperlink.set(qn("r:id"), r_id)
-        new_run = OxmlElement("w:r")
-        rPr = OxmlElement("w:rPr")
-        rStyle = OxmlElement("w:rStyle")
-        rStyle.set(qn("w:val"), "Hyperlink")
-        rPr.append(rStyle)
-        color = OxmlElement("w:color")
-        color.set(qn("w:val"), "0000FF")
-        rPr.append(color)
-        u_el = OxmlElement("w:u")
-        u_el.set(qn("w:val"), "single")
-        rPr.append(u_el)
-        new_run.append(rPr)
-        t = OxmlElement("w:t")
-        t.text = display_text or text
-        new_run.append(t)
-        hyperlink.append(new_run)
+        hyperlink[0][-1].text = display_text or text
         cast(Any, paragraph)._p.append(hyperlink)
     def _add_inline_equation(
         self,
@@ -2387,8 +3105,7 @@ class Action:
             )
             return
         try:
-            mathml = latex_to_mathml(latex)
-            omml = mathml2omml.convert(mathml)
+            omml = _latex_to_omml(latex)
             o_math = self._omml_oMath_element(omml)
             run = paragraph.add_run()
             run.bold = bold
@@ -2401,46 +3118,10 @@ class Action:
                 paragraph, f"\\({latex}\\)", bold=bold, italic=italic, strike=strike
             )
     def _omml_oMath_element(self, omml: str):
-        # Ensure the OMML element declares the math namespace so parse_xml works.
-        m_ns = "http://schemas.openxmlformats.org/officeDocument/2006/math"
-        s = (omml or "").strip()
-        if s.startswith("<m:oMath>") and s.endswith("</m:oMath>"):
-            inner = s[len("<m:oMath>") : -len("</m:oMath>")]
-            s = f'<m:oMath xmlns:m="{m_ns}">{inner}</m:oMath>'
-        elif s.startswith("<m:oMath") and "xmlns:m=" not in s.split(">", 1)[0]:
-            s = s.replace("<m:oMath", f'<m:oMath xmlns:m="{m_ns}"', 1)
-        return parse_xml(s)
+        # The cached parse declares the math namespace so parse_xml works.
+        return copy.deepcopy(_parse_omath(omml))
     def add_code_block(self, doc: Document, code: str, language: str = ""):
         """Add code block with syntax highlighting"""
-        # Token color mapping (based on common IDE themes)
-        TOKEN_COLORS = {
-            Token.Keyword: RGBColor(0, 92, 197),  # macOS blue - keywords
-            Token.Keyword.Constant: RGBColor(0, 92, 197),
-            Token.Keyword.Declaration: RGBColor(0, 92, 197),
-            Token.Keyword.Namespace: RGBColor(0, 92, 197),
-            Token.Keyword.Type: RGBColor(0, 92, 197),
-            Token.Name.Function: RGBColor(0, 0, 0),  # Functions stay black
-            Token.Name.Class: RGBColor(38, 82, 120),  # Deep cyan-blue - classes
-            Token.Name.Decorator: RGBColor(170, 51, 0),  # Warm orange - decorators
-            Token.Name.Builtin: RGBColor(0, 110, 71),  # Deep green - builtins
-            Token.String: RGBColor(196, 26, 22),  # Red - strings
-            Token.String.Doc: RGBColor(109, 120, 133),  # Gray - docstrings
-            Token.Comment: RGBColor(109, 120, 133),  # Gray - comments
-            Token.Comment.Single: RGBColor(109, 120, 133),
-            Token.Comment.Multiline: RGBColor(109, 120, 133),
-            Token.Number: RGBColor(28, 0, 207),  # Indigo - numbers
-            Token.Number.Integer: RGBColor(28, 0, 207),
-            Token.Number.Float: RGBColor(28, 0, 207),
-            Token.Operator: RGBColor(90, 99, 120),  # Gray-blue - operators
-            Token.Punctuation: RGBColor(0, 0, 0),  # Black - punctuation
-        }
-        def get_token_color(token_type):
-            """Recursively find token color"""
-            while token_type:
-                if token_type in TOKEN_COLORS:
-                    return TOKEN_COLORS[token_type]
-                token_type = token_type.parent
-            return None
         # Add language label if available
         if language:
             lang_para = doc.add_paragraph()
@@ -2452,67 +3133,62 @@ class Action:
             lang_run.font.size = Pt(8)
             lang_run.font.color.rgb = RGBColor(100, 100, 100)
             lang_run.font.bold = True
-        # Add code block paragraph
+        # Add code block paragraph: 0.5cm indent, light gray background, and less
+        # space before when the language label sits right above it.
         paragraph = doc.add_paragraph()
-        paragraph.paragraph_format.left_indent = Cm(0.5)
-        paragraph.paragraph_format.space_before = Pt(3) if language else Pt(6)
-        paragraph.paragraph_format.space_after = Pt(6)
-        # Add light gray background
-        shading = OxmlElement("w:shd")
-        shading.set(qn("w:fill"), "F7F7F7")
-        paragraph._element.pPr.append(shading)
-        # Try to use Pygments for syntax highlighting
+        ppr = _CODE_BLOCK_LABELED_PPR if language else _CODE_BLOCK_PPR
+        cast(Any, paragraph)._p.insert(0, copy.deepcopy(ppr))
+        # Try to use Pygments for syntax highlighting. Aliases are case-insensitive,
+        # so "Python" and "python" share a cache entry.
+        lexer = None
         if PYGMENTS_AVAILABLE and language:
-            try:
-                lexer = get_lexer_by_name(language, stripall=False)
-            except Exception:
-                lexer = TextLexer()
-            tokens = list(lex(code, lexer))
-            for token_type, token_value in tokens:
+            lexer = _get_lexer(language.lower())
+        # Unknown languages get the plain-text lexer: nothing to color, so they
+        # take the single-run path below instead of lexing.
+        if lexer is not None and lexer is not _TEXT_LEXER:
+            font = self.valves.FONT_CODE
+            p_elm = cast(Any, paragraph)._p
+            def _add_token_run(text: str, style: Tuple[Optional[RGBColor], bool]):
+                _append_run(p_elm, text, _code_block_run_rpr(font, *style))
+            # Adjacent tokens with the same (color, bold) share one run.
+            run_style: Tuple[Optional[RGBColor], bool] = (None, False)
+            parts: List[str] = []
+            for token_type, token_value in lex(code, lexer):
                 if not token_value:
                     continue
-                run = paragraph.add_run(token_value)
-                run.font.name = self.valves.FONT_CODE
-                run._element.rPr.rFonts.set(qn("w:eastAsia"), self.valves.FONT_CODE)
-                run.font.size = Pt(10)
-                # Apply color
-                color = get_token_color(token_type)
-                if color:
-                    run.font.color.rgb = color
-                # Bold keywords
-                if token_type in Token.Keyword:
-                    run.font.bold = True
+                style = _token_style(token_type)
+                if style != run_style:
+                    if parts:
+                        _add_token_run("".join(parts), run_style)
+                        parts.clear()
+                    run_style = style
+                parts.append(token_value)
+            if parts:
+                _add_token_run("".join(parts), run_style)
         else:
             # No syntax highlighting, plain text display
-            run = paragraph.add_run(code)
-            run.font.name = self.valves.FONT_CODE
-            run._element.rPr.rFonts.set(qn("w:eastAsia"), self.valves.FONT_CODE)
-            run.font.size = Pt(10)
+            rpr = _code_block_run_rpr(self.valves.FONT_CODE, None, False)
+            _append_run(cast(Any, paragraph)._p, code, rpr)
     def add_table(self, doc: Document, table_lines: List[str]):
         """Add Markdown table with sane Word sizing/spacing, alignment, and hyperlinks/math support in cells."""
         if len(table_lines) < 2:
             return
-        def _validate_hex(c: str, default: str) -> str:
-            c = c.strip().lstrip("#")
-            if re.fullmatch(r"[0-9A-Fa-f]{6}", c):
-                return c
-            return default
-        header_fill = _validate_hex(self.valves.TABLE_HEADER_COLOR, "F2F2F2")
-        zebra_fill = _validate_hex(self.valves.TABLE_ZEBRA_COLOR, "FBFBFB")
+        header_fill = _valid_hex_color(self.valves.TABLE_HEADER_COLOR, "F2F2F2")
+        zebra_fill = _valid_hex_color(self.valves.TABLE_ZEBRA_COLOR, "FBFBFB")
         def _split_row(line: str) -> List[str]:
             # Keep empty cells, trim surrounding pipes.
             raw = line.strip().strip("|")
             return [c.strip() for c in raw.split("|")]
-        def _is_separator_row(cells: List[str]) -> bool:
+        def _is_separator_cell(c: str) -> bool:
             # Markdown separator: --- / :--- / ---: / :---:
-            if not cells:
-                return False
-            ok = 0
-            for c in cells:
-                c = c.strip()
-                if re.fullmatch(r":?-{3,}:?", c):
-                    ok += 1
-            return ok == len(cells)
+            c = c.strip()
+            if c[:1] == ":":
+                c = c[1:]
+            if c[-1:] == ":":
+                c = c[:-1]
+            return len(c) >= 3 and c.count("-") == len(c)
+        def _is_separator_row(cells: List[str]) -> bool:
+            return bool(cells) and all(map(_is_separator_cell, cells))
         def _col_align(cell: str) -> WD_ALIGN_PARAGRAPH:
             s = (cell or "").strip()
             if s.startswith(":") and s.endswith(":"):
@@ -2522,21 +3198,50 @@ class Action:
             return WD_ALIGN_PARAGRAPH.LEFT
         def _set_cell_shading(cell, fill: str):
             tc_pr = cell._element.get_or_add_tcPr()
-            shd = OxmlElement("w:shd")
-            shd.set(qn("w:fill"), fill)
-            tc_pr.append(shd)
-        raw_rows = [_split_row(l) for l in table_lines if l.strip().startswith("|")]
-        if not raw_rows:
+            tc_pr.append(OxmlElement("w:shd", {_W_FILL: fill}))
+        def _plain_len(s: str) -> int:
+            # Length of the cell text as displayed: code/link markup dropped and
+            # whitespace runs collapsed. Most cells have no markup, so the
+            # substitutions only run when their marker is present.
+            t = s or ""
+            if "`" in t:
+                t = _MD_INLINE_CODE_RE.sub(r"\1", t)
+            if "[" in t:
+                t = _MD_LINK_RE.sub(r"\1", t)
+            words = t.split()
+            return sum(map(len, words)) + len(words) - 1 if words else 0
+        # One pass over the lines: split each row once, take the separator (second
+        # row only), and track the longest displayed text per column.
+        header: List[str] = []
+        separator: Optional[List[str]] = None
+        body: List[List[str]] = []
+        max_lens: List[int] = []
+        row_count = 0
+        for line in table_lines:
+            if not line.strip().startswith("|"):
+                continue
+            cells = _split_row(line)
+            row_count += 1
+            if row_count == 2 and _is_separator_row(cells):
+                separator = cells
+                continue
+            if row_count == 1:
+                header = cells
+            else:
+                body.append(cells)
+            if len(cells) > len(max_lens):
+                max_lens.extend([0] * (len(cells) - len(max_lens)))
+            for ci, cell_text in enumerate(cells):
+                cell_len = _plain_len(cell_text)
+                if cell_len > max_lens[ci]:
+                    max_lens[ci] = cell_len
+        if not row_count:
             return
-        sep_idx = 1 if len(raw_rows) > 1 and _is_separator_row(raw_rows[1]) else -1
-        header = raw_rows[0]
-        body = raw_rows[sep_idx + 1 :] if sep_idx >= 0 else raw_rows[1:]
-        num_cols = max(len(header), *(len(r) for r in body)) if body else len(header)
-        header = header + [""] * (num_cols - len(header))
-        body = [r + [""] * (num_cols - len(r)) for r in body]
-        aligns = [
-            _col_align(c) for c in (raw_rows[1] if sep_idx == 1 else [""] * num_cols)
-        ]
+        num_cols = len(max_lens)
+        for r in (header, *body):
+            if len(r) < num_cols:
+                r.extend([""] * (num_cols - len(r)))
+        aligns = [_col_align(c) for c in (separator or [""] * num_cols)]
         table = doc.add_table(rows=1 + len(body), cols=num_cols)
         table.style = "Table Grid"
         table.alignment = WD_TABLE_ALIGNMENT.LEFT
@@ -2546,17 +3251,7 @@ class Action:
         # Column widths: proportional to content, bounded, then normalized to page width.
         available_width = int(self._available_block_width(doc))
         min_col = max(int(Inches(0.55)), available_width // max(1, num_cols * 3))
-        def _plain_len(s: str) -> int:
-            t = re.sub(r"`([^`]+)`", r"\1", s or "")
-            t = re.sub(r"\[([^\]]+)\]\(([^)]+)\)", r"\1", t)
-            t = re.sub(r"\s+", " ", t).strip()
-            return len(t)
-        weights: List[int] = []
-        for ci in range(num_cols):
-            max_len = _plain_len(header[ci])
-            for r in body:
-                max_len = max(max_len, _plain_len(r[ci]))
-            weights.append(max(1, min(max_len, 40)))
+        weights = [max(1, min(max_len, 40)) for max_len in max_lens]
         sum_w = sum(weights) or 1
         widths = [max(min_col, int(available_width * w / sum_w)) for w in weights]
         total = sum(widths)
@@ -2572,29 +3267,41 @@ class Action:
                 widths[order[oi % len(order)]] += 1
                 rem -= 1
                 oi += 1
-        for ci, w in enumerate(widths):
-            table.columns[ci].width = w
-            for row in table.rows:
-                row.cells[ci].width = w
+        # Write grid and cell widths on the oxml elements in one pass over the rows;
+        # the column/row/cell wrappers rebuild the cell grid on every access. A new
+        # table has exactly num_cols w:tc per row.
+        tbl = cast(Any, table)._tbl
+        for grid_col, w in zip(tbl.tblGrid.gridCol_lst, widths):
+            grid_col.w = w
+        for tr in tbl.tr_lst:
+            for tc, w in zip(tr.tc_lst, widths):
+                tc.width = w
         def _format_cell_paragraph(para, align: WD_ALIGN_PARAGRAPH):
             para.alignment = align
             pf = para.paragraph_format
-            pf.space_before = Pt(0)
-            pf.space_after = Pt(0)
+            pf.space_before = _PT_0
+            pf.space_after = _PT_0
             pf.line_spacing_rule = WD_LINE_SPACING.SINGLE
         def _fill_cell(cell, text: str, align: WD_ALIGN_PARAGRAPH, bold: bool = False):
-            cell.text = ""
+            # Cells come fresh from add_table: a single empty paragraph, no runs.
             parts = [
-                p for p in re.split(r"(?:<br\s*/?>|\n)", text or "") if p is not None
+                p for p in _TABLE_CELL_BREAK_RE.split(text or "") if p is not None
             ]
             if not parts:
                 parts = [""]
+            run_rpr = _CELL_BOLD_RUN_RPR if bold else _CELL_RUN_RPR
             for pi, part in enumerate(parts):
                 para = cell.paragraphs[0] if pi == 0 else cell.add_paragraph()
                 _format_cell_paragraph(para, align)
+                if _INLINE_SPECIAL_RE.search(part) is None:
+                    # Plain text: one 9pt run without the inline parser.
+                    if part:
+                        run = para.add_run(part)
+                        cast(Any, run)._r.insert(0, copy.deepcopy(run_rpr))
+                    continue
                 self.add_formatted_text(para, part)
                 for run in para.runs:
-                    run.font.size = Pt(9)
+                    run.font.size = _PT_9
                     if bold:
                         run.bold = True
         # Header row
@@ -2646,16 +3353,17 @@ class Action:
         self, doc: Document, items: List[Tuple[int, str]], list_type: str
     ):
         """Add list"""
+        # Resolve the style once per list rather than by name for every item.
+        if list_type == "unordered":
+            # Unordered list with bullets
+            style = doc.styles["List Bullet"]
+        else:
+            # Ordered list with numbers
+            style = doc.styles["List Number"]
         for indent, text in items:
-            paragraph = doc.add_paragraph()
-            if list_type == "unordered":
-                # Unordered list with bullets
-                paragraph.style = "List Bullet"
-            else:
-                # Ordered list with numbers
-                paragraph.style = "List Number"
+            paragraph = doc.add_paragraph(style=style)
             # Set indent
-            paragraph.paragraph_format.left_indent = Cm(0.5 * (indent + 1))
+            paragraph.paragraph_format.left_indent = _list_left_indent(indent)
             # Add formatted text
             self.add_formatted_text(paragraph, text)
     def add_horizontal_rule(self, doc: Document):
@@ -2665,14 +3373,7 @@ class Action:
         paragraph.paragraph_format.space_after = Pt(12)
         # Add bottom border as horizontal rule
         pPr = paragraph._element.get_or_add_pPr()
-        pBdr = OxmlElement("w:pBdr")
-        bottom = OxmlElement("w:bottom")
-        bottom.set(qn("w:val"), "single")
-        bottom.set(qn("w:sz"), "6")
-        bottom.set(qn("w:space"), "1")
-        bottom.set(qn("w:color"), "auto")
-        pBdr.append(bottom)
-        pPr.append(pBdr)
+        pPr.append(copy.deepcopy(_HR_BORDER_TEMPLATE))
     def add_blockquote(self, doc: Document, text: str):
         """Add blockquote with left border and gray background"""
         for line in text.split("\n"):
@@ -2682,18 +3383,9 @@ class Action:
             paragraph.paragraph_format.space_after = Pt(3)
             # Add left border
             pPr = paragraph._element.get_or_add_pPr()
-            pBdr = OxmlElement("w:pBdr")
-            left = OxmlElement("w:left")
-            left.set(qn("w:val"), "single")
-            left.set(qn("w:sz"), "24")  # Border thickness
-            left.set(qn("w:space"), "4")  # Space between border and text
-            left.set(qn("w:color"), "CCCCCC")  # Gray border
-            pBdr.append(left)
-            pPr.append(pBdr)
+            pPr.append(copy.deepcopy(_BLOCKQUOTE_BORDER_TEMPLATE))
             # Add light gray background
-            shading = OxmlElement("w:shd")
-            shading.set(qn("w:fill"), "F9F9F9")
-            pPr.append(shading)
+            pPr.append(OxmlElement("w:shd", {_W_FILL: "F9F9F9"}))
             # Add formatted text
             self.add_formatted_text(paragraph, line)
             # Set font to italic gray
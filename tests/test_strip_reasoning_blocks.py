@@ -0,0 +1,69 @@
+import importlib.util
+import sys
+import types
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("docx")
+pytest.importorskip("pydantic")
+
+# The plugin imports a few Open WebUI names at module level; none of them are used
+# by the code under test, so stand-ins are enough outside an Open WebUI install.
+try:
+    import open_webui  # noqa: F401
+except ImportError:
+    for _name, _attrs in {
+        "open_webui": {},
+        "open_webui.models": {},
+        "open_webui.models.chats": {"Chats": None},
+        "open_webui.models.users": {"Users": None},
+        "open_webui.utils": {},
+        "open_webui.utils.chat": {"generate_chat_completion": None},
+    }.items():
+        _module = types.ModuleType(_name)
+        _module.__dict__.update(_attrs)
+        sys.modules[_name] = _module
+
+_MODULE_PATH = Path(__file__).resolve().parent.parent / "export_doc_func.py"
+_spec = importlib.util.spec_from_file_location("export_doc_func", _MODULE_PATH)
+export_doc_func = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(export_doc_func)
+
+
+@pytest.fixture(scope="module")
+def action():
+    return export_doc_func.Action()
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("no reasoning here", "no reasoning here"),
+        ("A<think>hidden</think>B", "AB"),
+        ("A<THINK>x</think>B<analysis>y</analysis>C", "ABC"),
+        (
+            'A<details type="reasoning" done="true">\n'
+            "<summary>Thought</summary>\n> hidden\n</details>\nAnswer",
+            "A\nAnswer",
+        ),
+        (
+            "<details><summary>Kept</summary>text</details>",
+            "<details><summary>Kept</summary>text</details>",
+        ),
+        # Nested blocks are removed whole.
+        ("<think>a<think>b</think>c</think>D", "D"),
+        ('<details type="reasoning">A<details>x</details>B</details>C', "C"),
+        # Reasoning that mentions its own tag names must still be removed.
+        ("A<think>The user asks about <think> tags</think>B", "AB"),
+        (
+            'A<details type="reasoning" done="true">\n'
+            "<summary>Thought</summary>\n"
+            "> I could wrap this in a <details> element.\n"
+            "</details>\nAnswer",
+            "A\nAnswer",
+        ),
+    ],
+)
+def test_strip_reasoning_blocks(action, text, expected):
+    assert action._strip_reasoning_blocks(text) == expected